@@ -37,62 +37,77 @@
     curl -X POST http://localhost:5000/config \
         -d "{\"SPARK_BOT_TOKEN\": \"<TOKEN>\", \"SPARK_BOT_EMAIL\": \"<EMAIL>"}"
 
+    The POST only configures the server process that handles it.  When running gunicorn with more than one
+    worker (BOT_WORKERS), set the token and email in the environment instead.
+
     You can read the configuration details with this request
 
     curl http://localhost:5000/config
 
 """
 
+# Imported first, so the startup time includes importing the other modules
+from startup import startup, try_server_lock
 from flask import Flask, request
-from ciscosparkapi import CiscoSparkAPI
 import os
 import sys
 import json
+import atexit
+import signal
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from utilities import check_cisco_user, verify_case_number, get_case_details, room_exists_for_user, create_membership, \
-                        get_email, get_person_id, create_room, get_room_name, extract_message, get_case_number, \
-                        invite_user, check_email_syntax
-from case import CaseDetail
+from utilities import verify_case_number, get_case_details, get_many_case_details, refresh_case_details, case_is_stale, room_exists_for_user, create_membership, \
+                        get_person_id, create_room, \
+                        invite_user, check_email_syntax, invalidate_case, check_cisco_person, remember_person, \
+                        remember_room, forget_room, rebuild_room_index, update_room_index, reset_connections, \
+                        get_spark, set_spark_token, get_access_token, get_room_counts, room_index, case_cache, room_cache, case_store, person_emails, person_ids, person_authorized
+from workers import WorkerPool
+from outbound import OutboundQueue
+from ratelimit import TokenBucket
+from dedupe import create_dedupe_store
+from context import RequestContext
+from message_parser import parse_message
+from monitor import CaseMonitor
+import metrics
+from tracing import start_trace, finish_trace, current_trace, span, recent_slow_traces
 
 # Create the Flask application that provides the bot foundation
 app = Flask(__name__)
 
 
 # ToDos:
-    # todo accept multiple case numbers, loop through cases?
     # todo add test cases for low hanging fruit in testing.py
     # todo timezone for tac engineer
     # todo add security check to match domain of user to case contact
     # todo start PSTS engagement
     # todo last note created with "action plan" or "next steps" in note detail
     # todo add RMA API functions
-    # todo monitor case and alert on changes
 
 
 # The list of commands the bot listens for
 # Each key in the dictionary is a command
 # The value is the help message sent for the command
-commands = {
-    "/title": "Get title for TAC case.",
-    # "/description": "Get problem description for the TAC case.",
-    "/owner": "Get case owner (TAC CSE) for TAC case.",
-    "/contract": "Get contract number associated with the TAC case.",
-    "/customer": "Get customer contact info for the TAC case.",
-    "/status": "Get status and severity for the TAC case.",
-    "/rma": "Get list of RMAs associated with TAC case.",
-    "/bug": "Get list of Bugs associated with TAC case.",
-    "/device": "Get serial number and hostname for the device on which the TAC case was opened",
-    "/created": "Get the date on which the TAC case was created, and calculate the open duration",
-    "/updated": "Get the date on which the TAC case was last updated, and calculate the time since last update",
-    "/invite": "Invite new user to room by email (or keywords: cse=case owner)",
-    "/link": "Get link to the case in Support Case Manager",
-    "/feedback": "Sends feedback to development team; use this to submit feature requests and bugs",
-    # "/last-note": "Sends the contents of the last note attached to the case",
-    # "/action-plan": "Sends the last note containing \"action plan\"",
-    # "/echo": "Reply back with the same message sent.",
-    # "/test": "Print test message.",
-    "/help": "Get help."
-}
+# Commands are added with the @bot_command decorator on their command function
+commands = OrderedDict()
+
+# The command function for each command
+command_functions = {}
+
+
+# Decorator to register a command function and its help message
+def bot_command(command, help_message):
+    def register(function):
+        commands[command] = help_message
+        command_functions[command] = function
+        return function
+    return register
+
+
+# Find the command that was sent, if any
+def find_command(text):
+    return parse_message(text, command_functions).command
 
 
 # Not strictly needed for most bots, but this allows for requests to be sent
@@ -114,7 +129,7 @@ def process_webhook():
         return "up"
 
     # Check if the Spark connection has been made
-    if spark is None:
+    if get_spark() is None:
         sys.stderr.write("Bot not ready.  \n")
         return "Spark Bot not ready.  "
 
@@ -123,11 +138,79 @@ def process_webhook():
     # sys.stderr.write("Webhook content:" + "\n")
     # sys.stderr.write(str(post_data) + "\n")
 
-    # Take the posted data and send to the processing function
-    process_incoming_message(post_data)
+    # Room updates only refresh the cached room title
+    if post_data.get("resource") == "rooms":
+        metrics.webhooks.inc("rooms", "processed")
+        process_room_update(post_data)
+        return ""
+
+    # Membership changes keep the room index current.  New rooms are looked up in Spark, so the change is
+    # processed by the worker pool.
+    if post_data.get("resource") == "memberships":
+        if not webhook_workers.submit(post_data):
+            metrics.webhooks.inc("memberships", "rejected")
+            sys.stderr.write("Webhook queue full, rejecting membership change.\n")
+            return "Spark Bot busy.  ", 503
+        metrics.webhooks.inc("memberships", "queued")
+        return ""
+
+    # Ignore messages sent by the bot itself, without any remote call
+    if is_bot(post_data["data"].get("personEmail"), post_data["data"].get("personId")):
+        metrics.webhooks.inc("messages", "self")
+        return ""
+
+    # Drop messages that Spark has already delivered, before any remote call is made
+    message_id = post_data["data"]["id"]
+    if webhook_dedupe.seen(message_id):
+        metrics.webhooks.inc("messages", "duplicate")
+        sys.stderr.write("Dropping duplicate delivery of message " + message_id + "\n")
+        return ""
+
+    # Acknowledge right away and let the worker pool process the message.
+    # If the queue is full, ask Spark to redeliver later instead of blocking the webhook.
+    if not webhook_workers.submit(post_data):
+        metrics.webhooks.inc("messages", "rejected")
+        sys.stderr.write("Webhook queue full, rejecting message.\n")
+        webhook_dedupe.forget(message_id)
+        return "Spark Bot busy.  ", 503
+    metrics.webhooks.inc("messages", "queued")
     return ""
 
 
+# Webhook queue stats, useful for watching backpressure
+@app.route("/queue", methods=["GET"])
+def queue_stats():
+    """
+    Return webhook queue depth and counters
+    :return:
+    """
+    stats = webhook_workers.stats()
+    stats["outbound"] = outbound.stats()
+    return json.dumps(stats)
+
+
+# Metrics in the Prometheus text format.
+# Each server process keeps its own metrics, so scrape every process, or run a single one.
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Return webhook, command, upstream, cache and queue metrics
+    :return:
+    """
+    return metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+# The most recent requests slower than SLOW_REQUEST_THRESHOLD, with their timing breakdown
+@app.route("/traces/slow", methods=["GET"])
+def slow_traces():
+    """
+    Return the N most recent slow traces, newest first
+    :return:
+    """
+    limit = request.args.get("limit", 10, type=int)
+    return json.dumps(recent_slow_traces(limit))
+
+
 # Config Endpoint to set Spark Details
 @app.route('/config', methods=["GET", "POST"])
 def config_bot():
@@ -139,6 +222,7 @@ def config_bot():
 
         # Setup Spark
         spark_setup(post_data["SPARK_BOT_EMAIL"], post_data["SPARK_BOT_TOKEN"])
+        start_background_setup()
 
     # Return the config detail to API requests
     config_data = {
@@ -160,13 +244,14 @@ def message_email(email):
     :return:
     """
     # Check if the Spark connection has been made
-    if spark is None:
+    if get_spark() is None:
         sys.stderr.write("Bot not ready.  \n")
         return "Spark Bot not ready.  "
 
     # send_message_to_email(email, "Hello!")
-    spark.messages.create(toPersonEmail=email, markdown="Hello!")
-    return "Message sent to " + email
+    if not send_message(toPersonEmail=email, markdown="Hello!"):
+        return "Unable to send message to " + email + ", the outbound queue is full"
+    return "Message queued for " + email
 
 
 # Health Check
@@ -179,6 +264,25 @@ def health_check():
     return "Up and healthy"
 
 
+# Readiness Check, separate from the health check: the bot is only ready to take webhooks once Spark is
+# configured and the startup checks have passed
+@app.route("/ready", methods=["GET"])
+def ready_check():
+    """
+    Return the startup checks, cache warm-up state and startup timing breakdown
+    :return:
+    """
+    state = startup.to_dict()
+    state["caches"] = {
+        "room_index_built": room_index.built,
+        "case_cache_entries": len(case_cache),
+        "room_cache_entries": len(room_cache)
+    }
+    if case_store is not None:
+        state["caches"]["case_store"] = case_store.stats()
+    return json.dumps(state), 200 if state["ready"] else 503, {"Content-Type": "application/json"}
+
+
 # REST API for room creation
 @app.route("/create/<provided_case_number>/<email>", methods=["GET"])
 def create(provided_case_number, email):
@@ -188,7 +292,7 @@ def create(provided_case_number, email):
     :return:
     """
     # Check if the Spark connection has been made
-    if spark is None:
+    if get_spark() is None:
         sys.stderr.write("Bot not ready.  \n")
         return "Spark Bot not ready.  "
 
@@ -220,8 +324,10 @@ def create(provided_case_number, email):
                 message = message+membership_message
 
             # Print Welcome message to room
-            spark.messages.create(roomId=room_id, markdown=send_help(False))
-            welcome_message = "Welcome message (with help command) sent to the room.\n"
+            if send_message(roomId=room_id, markdown=send_help(False)):
+                welcome_message = "Welcome message (with help command) queued for the room.\n"
+            else:
+                welcome_message = "Unable to send the welcome message, the outbound queue is full.\n"
             sys.stderr.write(welcome_message)
             message = message+welcome_message
         else:
@@ -234,6 +340,38 @@ def create(provided_case_number, email):
     return message
 
 
+# REST API to mark cached case details as stale, so the next command refetches them
+@app.route("/refresh/<provided_case_number>", methods=["GET"])
+def refresh_case(provided_case_number):
+    """
+    Drop cached details for case number
+    :param provided_case_number:
+    :return:
+    """
+    case_number = verify_case_number(provided_case_number)
+    if not case_number:
+        return provided_case_number+" is not a valid case number"
+
+    if invalidate_case(case_number):
+        return "Cached details for SR "+case_number+" marked stale\n"
+    return "No cached details for SR "+case_number+"\n"
+
+
+# REST API to rebuild the case room index from a full scan of the bot's rooms
+@app.route("/rooms/reindex", methods=["GET"])
+def reindex_rooms():
+    """
+    Rebuild the case number -> rooms -> members index
+    :return:
+    """
+    # Check if the Spark connection has been made
+    if get_spark() is None:
+        sys.stderr.write("Bot not ready.  \n")
+        return "Spark Bot not ready.  "
+
+    return "Indexed {} case rooms\n".format(rebuild_room_index())
+
+
 # Room counter - returns the number of rooms for which TAC bot is a member
 # Useful for tracking utilization of TAC bot
 @app.route("/rooms", methods=["GET"])
@@ -242,11 +380,29 @@ def room_count():
     Notify if bot is up
     :return:
     """
-    return "{}\n".format(sum(1 for x in spark.rooms.list()))
+    counts = get_room_counts()
+    if counts is None:
+        return "Counting rooms, try again shortly\n", 503
+    return "{}\n".format(counts["total"])
+
+
+# Room counts by case rooms vs other rooms, and open vs closed cases
+@app.route("/rooms/counts", methods=["GET"])
+def room_counts():
+    """
+    Return the room counts kept up to date from membership webhooks
+    :return:
+    """
+    counts = get_room_counts()
+    if counts is None:
+        return "Counting rooms, try again shortly\n", 503
+    return json.dumps(counts)
 
 
 # Function to Setup the WebHook for the bot
-def setup_webhook(name, targeturl):
+def setup_webhook(name, targeturl, resource="messages", event="created"):
+    spark = get_spark()
+
     # Get a list of current webhooks
     webhooks = spark.webhooks.list()
 
@@ -262,199 +418,262 @@ def setup_webhook(name, targeturl):
         # If there wasn't a Webhook found
         if wh is None:
             sys.stderr.write("Creating new webhook.\n")
-            wh = spark.webhooks.create(name=name, targetUrl=targeturl, resource="messages", event="created")
+            wh = spark.webhooks.create(name=name, targetUrl=targeturl, resource=resource, event=event)
     except:
         sys.stderr.write("Creating new webhook.\n")
-        wh = spark.webhooks.create(name=name, targetUrl=targeturl, resource="messages", event="created")
+        wh = spark.webhooks.create(name=name, targetUrl=targeturl, resource=resource, event=event)
 
     return wh
 
 
-# Function to take action on incoming message
+# Function to refresh the cached title of a room that was updated
+def process_room_update(post_data):
+    room_id = post_data["data"]["id"]
+    forget_room(room_id)
+    if "title" in post_data["data"]:
+        remember_room(room_id, post_data["data"]["title"])
+
+
+# Function to update the room index when someone joins or leaves a room
+def process_membership_update(post_data):
+    room_id = post_data["data"]["roomId"]
+    person_id = post_data["data"]["personId"]
+    update_room_index(post_data["event"], room_id, person_id, bot_left=is_bot(person_id=person_id))
+
+
+# Process a webhook taken from the worker pool's queue
+def process_queued_webhook(post_data):
+    if post_data.get("resource") == "memberships":
+        process_membership_update(post_data)
+    else:
+        process_incoming_message(post_data)
+
+
+# Process an incoming message in its own trace, so the time of slow requests can be broken down
 def process_incoming_message(post_data):
+    start_trace("message", message_id=post_data["data"]["id"], room_id=post_data["data"]["roomId"])
+    try:
+        handle_incoming_message(post_data)
+    finally:
+        finish_trace()
+
+
+# Function to take action on incoming message
+def handle_incoming_message(post_data):
     # Determine the Spark Room to send reply to
     room_id = post_data["data"]["roomId"]
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message = spark.messages.get(message_id)
+    message = get_spark().messages.get(message_id)
     # Uncomment to debug
     # sys.stderr.write("Message content:" + "\n")
     # sys.stderr.write(str(message) + "\n")
 
     # First make sure not processing a message from the bot
-    if message.personEmail in spark.people.me().emails:
+    if is_bot(message.personEmail, message.personId):
         # Uncomment to debug
         # sys.stderr.write("Message from bot recieved." + "\n")
         return ""
 
+    # The message tells us the sender's email for free, keep it for later lookups
+    remember_person(message.personId, message.personEmail)
+
     # Log details on message
     sys.stderr.write("Message from {}: {}\n".format(message.personEmail, message.text))
 
-    # Find the command that was sent, if any
-    command = ""
-    for c in commands.items():
-        if message.text.find(c[0]) != -1:
-            command = c[0]
-            sys.stderr.write("Found command: " + command + "\n")
-            # If a command was found, stop looking for others
-            break
+    # Find the command that was sent, if any, along with the case numbers and emails following it
+    parsed = parse_message(message.text, command_functions)
+    command = parsed.command
+    if command:
+        sys.stderr.write("Found command: " + command + "\n")
 
-    reply = ""
     # Take action based on command
     # If no command found, send help
-    if command in ["", "/help"]:
-        reply = send_help(post_data)
-        sys.stderr.write("Sent help message")
-    # elif command in ["/echo"]:
-        # reply = send_echo(message)
-    # elif command in ["/test"]:
-        # reply = send_test()
-    elif command in ["/title"]:
-        reply = send_title(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/owner"]:
-        reply = send_owner(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    # elif command in ["/description"]:
-    #     reply = send_description(post_data)
-    #     sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/contract"]:
-        reply = send_contract(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/customer"]:
-        reply = send_customer(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/status"]:
-        reply = send_status(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/rma"]:
-        reply = send_rma_numbers(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/feedback"]:
-        # If feedback is blank, dont send it
-        feedback = send_feedback(post_data, "feedback")
-        feedback_room = os.environ.get("FEEDBACK_ROOM")
-        if feedback is not None:
-            spark.messages.create(roomId=feedback_room, markdown=feedback)
-            reply = send_feedback(post_data, "reply")
-        else:
-            reply = "Sorry, cannot submit blank feedback"
-    elif command in ["/created"]:
-        reply = send_created(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/updated"]:
-        reply = send_updated(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/device"]:
-        reply = send_device(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/bug"]:
-        reply = send_bug(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
-    elif command in ["/link"]:
-        reply = send_link(post_data)
-    elif command in ["/invite"]:
-        reply = send_invite(post_data)
-    # elif command in ["/last-note"]:
-    #     reply = send_last_note(post_data)
-    # elif command in ["/action-plan"]:
-    #     reply = send_action_plan(post_data)
+    command_function = command_functions.get(command, send_help)
+    command_label = command or "/help"
+    current_trace().attributes["command"] = command_label
+    started = time.time()
+    try:
+        with span("command " + command_label):
+            reply = command_function(RequestContext(post_data, message, parsed))
+    except Exception:
+        metrics.command_errors.inc(command_label)
+        raise
+    finally:
+        metrics.command_duration.observe(time.time() - started, command_label)
+    sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
 
     # send_message_to_room(room_id, reply)
-    spark.messages.create(roomId=room_id, markdown=reply)
+    send_message(roomId=room_id, markdown=reply)
 
 
-#
-# Command functions
-#
+# Webhooks are processed in the background by a pool of workers fed from a bounded queue
+webhook_workers = WorkerPool(process_queued_webhook,
+                             num_workers=int(os.environ.get("WEBHOOK_WORKERS", "4")),
+                             max_depth=int(os.environ.get("WEBHOOK_QUEUE_DEPTH", "100")),
+                             name="webhook")
 
-# Sends feedback to Bot developers and replies with confirmation
-def send_feedback(post_data, type):
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
 
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/feedback", message_in.text)
+# Message ids already handled, so redelivered webhooks are only processed once
+webhook_dedupe = create_dedupe_store()
 
-    # Get personId of the person submitting feedback
-    person_id = post_data["data"]["personId"]
 
-    if type == "feedback":
-        email = get_email(person_id)
-        if content:
-            message = "User {} provided the following feedback:<br>{}".format(email, content)
-        else:
-            message = None
-    elif type == "reply":
-        message = "Thank you. Your feedback has been sent to developers"
-    else:
-        message = None
+# Replies are posted to Spark in the background, within Spark's rate limit for the bot.
+# Messages to the same room are posted in the order they were queued.
+outbound = OutboundQueue(lambda message: get_spark().messages.create(**message),
+                         TokenBucket(float(os.environ.get("OUTBOUND_RATE", "10")),
+                                     float(os.environ.get("OUTBOUND_BURST", "20"))),
+                         num_workers=int(os.environ.get("OUTBOUND_WORKERS", "4")),
+                         max_depth=int(os.environ.get("OUTBOUND_QUEUE_DEPTH", "1000")),
+                         max_retries=int(os.environ.get("OUTBOUND_MAX_RETRIES", "5")))
 
-    return message
 
+# Queue a message to be posted to Spark, to a roomId or toPersonEmail
+def send_message(**message):
+    key = message.get("roomId") or message.get("toPersonEmail")
+    if not key:
+        sys.stderr.write("Not sending message without a roomId or toPersonEmail: {}\n".format(message))
+        return False
+    return outbound.submit(key, message)
 
-# Sends feedback to Bot developers and replies with confirmation
-def send_link(post_data):
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
 
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/link", message_in.text)
+# Caches reported on /metrics
+metric_caches = {
+    "case": case_cache,
+    "room": room_cache,
+    "person_email": person_emails,
+    "person_id": person_ids,
+    "person_authorized": person_authorized
+}
 
-    # Get personId of the person submitting feedback
-    person_id = post_data["data"]["personId"]
+# Cache and queue metrics are read when /metrics is scraped
+metrics.registry.collector("tacbot_cache_requests_total", "Cache lookups, by cache and result", ["cache", "result"],
+                           lambda: [((name, result), cache.stats()[key])
+                                    for name, cache in sorted(metric_caches.items())
+                                    for result, key in (("hit", "hits"), ("miss", "misses"))],
+                           metric_type="counter")
+metrics.registry.collector("tacbot_cache_entries", "Entries in each cache", ["cache"],
+                           lambda: [((name,), len(cache)) for name, cache in sorted(metric_caches.items())])
+metrics.registry.collector("tacbot_webhook_queue_depth", "Webhooks waiting for a worker", [],
+                           lambda: [((), webhook_workers.depth())])
+metrics.registry.collector("tacbot_outbound_queue_depth", "Messages waiting to be posted to Spark", [],
+                           lambda: [((), outbound.depth())])
+metrics.registry.collector("tacbot_rooms", "Rooms the bot is a member of, by kind", ["kind"],
+                           lambda: [((kind,), count) for kind, count in sorted(room_index.counts().items())
+                                    if kind != "total"] if room_index.built else [])
+metrics.registry.collector("tacbot_watched_cases", "Cases watched by the case monitor", [],
+                           lambda: [((), len(case_monitor))])
+
+
+# Watched cases are polled in the background, and changes are posted to the watching rooms.
+# Set CASE_WATCH_PATH to share the watch list between server processes and keep it across restarts.
+case_monitor = CaseMonitor(fetch=refresh_case_details,
+                           notify=lambda room_id, markdown: send_message(roomId=room_id, markdown=markdown),
+                           path=os.environ.get("CASE_WATCH_PATH"),
+                           polls_per_second=float(os.environ.get("MONITOR_POLLS_PER_SECOND", "2")))
+
+# Without CASE_WATCH_PATH each server process has its own watch list, so with several processes /watch is refused:
+# the watch would be polled by one worker only and could not be removed with /unwatch from the others
+WATCHES_SHARED = bool(case_monitor.path) or int(os.environ.get("BOT_WORKERS", "1")) <= 1
+
+
+# Finish processing queued webhooks, and post their replies, before the process exits
+@atexit.register
+def shutdown_workers():
+    case_monitor.stop()
+    webhook_workers.shutdown(timeout=float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "20")))
+    outbound.shutdown(timeout=float(os.environ.get("OUTBOUND_DRAIN_TIMEOUT", "5")))
+    if case_store is not None:
+        case_store.close()
 
-    external_link_url = "https://mycase.cloudapps.cisco.com/"
-    internal_link_url = "http://www-tac.cisco.com/Teams/ks/c3/casekwery.php?Case="
 
-    # Find case number
-    case_number = get_case_number(content, room_id)
+#
+# Command functions
+#
 
-    if case_number:
-        message = "* Externally accessible link: {}{}\n".format(external_link_url, case_number)
-        message = message + "* Internal link: {}{}".format(internal_link_url, case_number)
-    else:
-        message = "Invalid case number"
+# Maximum number of case numbers handled by a single case command
+CASE_MAX_PER_COMMAND = int(os.environ.get("CASE_MAX_PER_COMMAND", "25"))
 
-    return message
 
+# Decorator to register a case command. The command function formats the reply for a single case,
+# and is called for every case number found in the message.
+def case_command(command, help_message):
+    def register(function):
+        bot_command(command, help_message)(lambda ctx: send_case_replies(ctx, function))
+        return function
+    return register
 
-# Returns case title for provided case number
-def send_title(post_data):
+
+# Fetch the details of every case number in the message concurrently, and combine the replies
+def send_case_replies(ctx, case_reply):
     """
     Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
     access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
     """
     # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
+    if not check_cisco_person(ctx.person_id):
         return "Sorry, CASE API access is limited to Cisco Employees for the time being"
 
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/title", message_in.text)
+    # Find case numbers
+    case_numbers = ctx.case_numbers
+    if not case_numbers:
+        return "Invalid case number"
 
-    # Find case number
-    case_number = get_case_number(content, room_id)
+    messages = []
+    for case_number, case in zip(case_numbers, get_many_case_details(case_numbers[:CASE_MAX_PER_COMMAND])):
+        if case is None:
+            messages.append("Unable to get details for SR {} at this time".format(case_number))
+            continue
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
         if not case.error:
-            case_title = case.title
-            message = "Title for SR {} is: {}".format(case_number, case_title)
+            messages.append(case_reply(case_number, case) + case_age_note(case))
+        elif len(case_numbers) > 1:
+            messages.append("SR {}: {}".format(case_number, case.error))
         else:
-            message = "{}".format(case.error)
+            messages.append("{}".format(case.error))
+
+    if len(case_numbers) > CASE_MAX_PER_COMMAND:
+        messages.append("Only the first {} case numbers were looked up".format(CASE_MAX_PER_COMMAND))
+
+    return "\n\n".join(messages)
+
+
+# Note the age of stale case details, which are being refreshed in the background
+def case_age_note(case):
+    if not case_is_stale(case):
+        return ""
+    return "<br>_As of {} ago_".format(timedelta(seconds=int(time.time() - case.fetched_at)))
+
+
+# Sends feedback to Bot developers and replies with confirmation
+@bot_command("/feedback", "Sends feedback to development team; use this to submit feature requests and bugs")
+def send_feedback(ctx):
+    # If feedback is blank, dont send it
+    if not ctx.argument:
+        return "Sorry, cannot submit blank feedback"
+
+    feedback = "User {} provided the following feedback:<br>{}".format(ctx.person_email, ctx.argument)
+    send_message(roomId=os.environ.get("FEEDBACK_ROOM"), markdown=feedback)
+    return "Thank you. Your feedback has been sent to developers"
+
+
+# Sends feedback to Bot developers and replies with confirmation
+@bot_command("/link", "Get link to the case in Support Case Manager")
+def send_link(ctx):
+    external_link_url = "https://mycase.cloudapps.cisco.com/"
+    internal_link_url = "http://www-tac.cisco.com/Teams/ks/c3/casekwery.php?Case="
+
+    # Find case numbers
+    case_numbers = ctx.case_numbers
+
+    if case_numbers:
+        messages = []
+        for case_number in case_numbers:
+            message = "* Externally accessible link: {}{}\n".format(external_link_url, case_number)
+            message = message + "* Internal link: {}{}".format(internal_link_url, case_number)
+            messages.append(message)
+        message = "\n\n".join(messages)
     else:
         message = "Invalid case number"
 
@@ -462,44 +681,25 @@ def send_title(post_data):
 
 
 # Returns case title for provided case number
-def send_device(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
+@case_command("/title", "Get title for TAC case.")
+def send_title(case_number, case):
+    case_title = case.title
+    message = "Title for SR {} is: {}".format(case_number, case_title)
 
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/device", message_in.text)
+    return message
 
-    # Find case number
-    case_number = get_case_number(content, room_id)
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get device info from case
-            device_serial = case.serial
-            # hostname doesn't exist in case api v3
-            # device_hostname = case.hostname
-            if device_serial != "":
-                message = "Device serial number for SR {} is: {}".format(case_number, device_serial)
-            else:
-                message = "Device serial number for SR {} is not provided".format(case_number)
-        else:
-            message = "{}".format(case.error)
+# Returns case title for provided case number
+@case_command("/device", "Get serial number and hostname for the device on which the TAC case was opened")
+def send_device(case_number, case):
+    # Get device info from case
+    device_serial = case.serial
+    # hostname doesn't exist in case api v3
+    # device_hostname = case.hostname
+    if device_serial != "":
+        message = "Device serial number for SR {} is: {}".format(case_number, device_serial)
     else:
-        message = "Invalid case number"
+        message = "Device serial number for SR {} is not provided".format(case_number)
 
     return message
 
@@ -508,6 +708,7 @@ def send_device(post_data):
 '''
 # problem description doesnt exist in case api v3
 # removing from new version
+# @bot_command("/description", "Get problem description for the TAC case.")
 def send_description(post_data):
     """
     Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
@@ -515,8 +716,7 @@ def send_description(post_data):
     """
     # Check if user is cisco.com
     person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
+    if not check_cisco_person(person_id):
         return "Sorry, CASE API access is limited to Cisco Employees for the time being"
 
     # Determine the Spark Room to send reply to
@@ -532,7 +732,7 @@ def send_description(post_data):
 
     if case_number:
         # Create case object
-        case = CaseDetail(get_case_details(case_number))
+        case = get_case_details(case_number)
         if case.count > 0:
             # Get case description
             case_description = case.description
@@ -547,379 +747,194 @@ def send_description(post_data):
 
 
 # Returns the owner of the TAC case number provided
-def send_owner(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/owner", message_in.text)
-
-    # Find case number
-    case_number = get_case_number(content, room_id)
+@case_command("/owner", "Get case owner (TAC CSE) for TAC case.")
+def send_owner(case_number, case):
+    # Get owner info from case
+    owner_name = case.owner_name
+    owner_email = case.owner_email
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get owner info from case
-            owner_name = case.owner_name
-            owner_email = case.owner_email
-
-            message = "Case owner for SR {} is: {} ({})".format(case_number, owner_name, owner_email)
-        else:
-            message = "{}".format(case.error)
-    else:
-        message = "Invalid case number"
+    message = "Case owner for SR {} is: {} ({})".format(case_number, owner_name, owner_email)
 
     return message
 
 
 # Returns contract number for provided case number
-def send_contract(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/contract", message_in.text)
-
-    # Find case number
-    case_number = get_case_number(content, room_id)
-
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get case description
-            case_contract = case.contract
-            message = "The contract number used to open SR {} is: {}".format(case_number, case_contract)
-        else:
-            message = "{}".format(case.error)
-    else:
-        message = "Invalid case number"
+@case_command("/contract", "Get contract number associated with the TAC case.")
+def send_contract(case_number, case):
+    # Get case description
+    case_contract = case.contract
+    message = "The contract number used to open SR {} is: {}".format(case_number, case_contract)
 
     return message
 
 
 # Returns the owner of the TAC case number provided
-def send_customer(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/customer", message_in.text)
-
-    # Find case number
-    case_number = get_case_number(content, room_id)
-
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get owner info from case
-            customer_id = case.customer_id
-            customer_name = case.customer_name
-            customer_email = case.customer_email
-            customer_business = case.customer_business
-            customer_mobile = case.customer_mobile
-
-            message = "Customer contact for SR {} is: **{}**".format(case_number, customer_name)
-            message = message + "<br>CCO ID: {}".format(customer_id)
-            message = message + "<br>Email: {}".format(customer_email[0]) if customer_email != "" else message
-            message = message + "<br>Business phone: {}".format(customer_business[0]) if customer_business != "" else message
-            message = message + "<br>Mobile phone: {}".format(customer_mobile[0]) if customer_mobile != "" else message
-        else:
-            message = "{}".format(case.error)
-    else:
-        message = "Invalid case number"
+@case_command("/customer", "Get customer contact info for the TAC case.")
+def send_customer(case_number, case):
+    # Get owner info from case
+    customer_id = case.customer_id
+    customer_name = case.customer_name
+    customer_email = case.customer_email
+    customer_business = case.customer_business
+    customer_mobile = case.customer_mobile
+
+    message = "Customer contact for SR {} is: **{}**".format(case_number, customer_name)
+    message = message + "<br>CCO ID: {}".format(customer_id)
+    message = message + "<br>Email: {}".format(customer_email[0]) if customer_email != "" else message
+    message = message + "<br>Business phone: {}".format(customer_business[0]) if customer_business != "" else message
+    message = message + "<br>Mobile phone: {}".format(customer_mobile[0]) if customer_mobile != "" else message
 
     return message
 
 
 # Returns case status and severity for provided case number
-def send_status(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/title", message_in.text)
-
-    # Find case number
-    case_number = get_case_number(content, room_id)
-
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get case status and severity
-            case_status = case.status
-            case_severity = case.severity
-            if "Closed" in case_status:
-                message = "Status for SR {} is {}".format(case_number, case_status)
-            else:
-                message = "Status for SR {} is {} and Severity is {}".format(case_number, case_status, case_severity)
-        else:
-            message = "{}".format(case.error)
+@case_command("/status", "Get status and severity for the TAC case.")
+def send_status(case_number, case):
+    # Get case status and severity
+    case_status = case.status
+    case_severity = case.severity
+    if "Closed" in case_status:
+        message = "Status for SR {} is {}".format(case_number, case_status)
     else:
-        message = "Invalid case number"
+        message = "Status for SR {} is {} and Severity is {}".format(case_number, case_status, case_severity)
 
     return message
 
 
 # Returns the RMA numbers if any are associated with the case
-def send_rma_numbers(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/rma", message_in.text)
-
-    # Find case number
-    case_number = get_case_number(content, room_id)
-
+@case_command("/rma", "Get list of RMAs associated with TAC case.")
+def send_rma_numbers(case_number, case):
     # Define URL for RMA lookup link
     rma_url = "http://msvodb.cloudapps.cisco.com/support/serviceordertool/orderDetails.svo?orderNumber="
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get RMAs from case
-            rmas = case.rmas
-            if len(rmas) > 0:
-                message = "The RMAs for SR {} are:\n".format(case_number)
-                for r in rmas:
-                     message = message + "* <a href=\"{}{}\">{}</a>\n".format(rma_url, r, r)
-            else:
-                message = "There are no RMAs for SR {}".format(case_number)
-        else:
-            message = "{}".format(case.error)
+    # Get RMAs from case
+    rmas = case.rmas
+    if len(rmas) > 0:
+        message = "The RMAs for SR {} are:\n".format(case_number)
+        for r in rmas:
+             message = message + "* <a href=\"{}{}\">{}</a>\n".format(rma_url, r, r)
     else:
-        message = "Invalid case number"
+        message = "There are no RMAs for SR {}".format(case_number)
 
     return message
 
 
 # Returns the Bug IDs if any are associated with the case
-def send_bug(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    # Get the details about the message that was sent.
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/bug", message_in.text)
-
-    # Find case number
-    case_number = get_case_number(content, room_id)
-
+@case_command("/bug", "Get list of Bugs associated with TAC case.")
+def send_bug(case_number, case):
     # Define URL for RMA lookup link
     bug_url = "https://bst.cloudapps.cisco.com/bugsearch/bug/"
     internal_bug_url = "http://cdets.cisco.com/apps/dumpcr?&content=summary&format=html&identifier="
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get Bugs from case
-            bugs = case.bugs
-            if len(bugs) > 0:
-                message = "The Bugs for SR {} are:\n".format(case_number)
-                for b in bugs:
-                    message = message + "* {} (<a href=\"{}{}\">external</a> | <a href=\"{}{}\">internal</a>)\n".format(b,bug_url, b, internal_bug_url, b)
-            else:
-                message = "There are no Bugs for SR {}".format(case_number)
-        else:
-            message = "{}".format(case.error)
+    # Get Bugs from case
+    bugs = case.bugs
+    if len(bugs) > 0:
+        message = "The Bugs for SR {} are:\n".format(case_number)
+        for b in bugs:
+            message = message + "* {} (<a href=\"{}{}\">external</a> | <a href=\"{}{}\">internal</a>)\n".format(b,bug_url, b, internal_bug_url, b)
     else:
-        message = "Invalid case number"
+        message = "There are no Bugs for SR {}".format(case_number)
 
     return message
 
 
 # Returns case creation date for provided case number, and if case is still open return open duration as well
-def send_created(post_data):
-    """
-    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
-    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
-    """
-    # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
-        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
-
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
+@case_command("/created", "Get the date on which the TAC case was created, and calculate the open duration")
+def send_created(case_number, case):
+    # Get the creation datetime from the case details
+    case_create_date = case.created_at
+    message = "Creation date for SR {} is: {}".format(case_number, case_create_date)
+
+    # Get time delta between creation and now; if case is still open, append with open duration
+    current_time = datetime.now()
+    current_time = current_time.replace(microsecond=0)
+    time_delta = current_time - case_create_date
+    status = case.status
+    if "Closed" not in status:
+        message = message + "<br>Case has been open for {}".format(time_delta)
+    else:
+        message = message + "<br>Case is now Closed"
 
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/created", message_in.text)
+    return message
 
-    # Find case number
-    case_number = get_case_number(content, room_id)
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get the creation datetime from the case details
-            case_create_date = case.created
-            case_create_date = datetime.strptime(case_create_date, '%Y-%m-%dT%H:%M:%S.%fZ')
-            message = "Creation date for SR {} is: {}".format(case_number, case_create_date)
-
-            # Get time delta between creation and now; if case is still open, append with open duration
-            current_time = datetime.now()
-            current_time = current_time.replace(microsecond=0)
-            time_delta = current_time - case_create_date
-            status = case.status
-            if "Closed" not in status:
-                message = message + "<br>Case has been open for {}".format(time_delta)
-            else:
-                message = message + "<br>Case is now Closed"
-        else:
-            message = "{}".format(case.error)
+# Returns case last updated date for provided case number, and if case is still open return duration since update as well
+@case_command("/updated", "Get the date on which the TAC case was last updated, and calculate the time since last update")
+def send_updated(case_number, case):
+    # Get the update datetime from the case details
+    case_update_date = case.updated_at
+    message = "Last update for SR {} was: {}".format(case_number, case_update_date)
+
+    # Get time delta between last updated and now
+    current_time = datetime.now()
+    current_time = current_time.replace(microsecond=0)
+    time_delta = current_time - case_update_date
+    status = case.status
+    if "Closed" in status:
+        message = message + "<br>Case is now Closed, {} since case closure".format(time_delta)
     else:
-        message = "Invalid case number"
+        # If case hasn't been updated in 3 days, make the text bold
+        if time_delta > timedelta(3):
+            message = message + "<br>**{} since last update**".format(time_delta)
+        else:
+            message = message + "<br>{} since last update".format(time_delta)
 
     return message
 
 
-# Returns case last updated date for provided case number, and if case is still open return duration since update as well
-def send_updated(post_data):
+# Start watching cases for changes, alerting this room
+@bot_command("/watch", "Watch the TAC case and alert this room when its status, severity, owner, RMAs, bugs or last update change")
+def send_watch(ctx):
     """
     Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
     access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
     """
     # Check if user is cisco.com
-    person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
+    if not check_cisco_person(ctx.person_id):
         return "Sorry, CASE API access is limited to Cisco Employees for the time being"
 
-    # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
+    # Find case numbers
+    case_numbers = ctx.case_numbers
+    if not case_numbers:
+        return "Invalid case number"
 
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/updated", message_in.text)
+    if not WATCHES_SHARED:
+        sys.stderr.write("Refusing /watch: CASE_WATCH_PATH is not set and BOT_WORKERS is above 1\n")
+        return "Sorry, watching cases is not available on this server"
 
-    # Find case number
-    case_number = get_case_number(content, room_id)
+    for case_number in case_numbers:
+        case_monitor.watch(case_number, ctx.room_id)
+    return "Watching SR {} for changes. Use /unwatch to stop.".format(", ".join(case_numbers))
 
-    if case_number:
-        # Create case object
-        case = CaseDetail(get_case_details(case_number))
-        if not case.error:
-            # Get the update datetime from the case details
-            case_update_date = case.updated
-            case_update_date = datetime.strptime(case_update_date, '%Y-%m-%dT%H:%M:%S.%fZ')
-            message = "Last update for SR {} was: {}".format(case_number, case_update_date)
-
-            # Get time delta between last updated and now
-            current_time = datetime.now()
-            current_time = current_time.replace(microsecond=0)
-            time_delta = current_time - case_update_date
-            status = case.status
-            if "Closed" in status:
-                message = message + "<br>Case is now Closed, {} since case closure".format(time_delta)
-            else:
-                # If case hasn't been updated in 3 days, make the text bold
-                if time_delta > timedelta(3):
-                    message = message + "<br>**{} since last update**".format(time_delta)
-                else:
-                    message = message + "<br>{} since last update".format(time_delta)
-        else:
-            message = "{}".format(case.error)
-    else:
-        message = "Invalid case number"
 
-    return message
+# Stop watching cases in this room
+@bot_command("/unwatch", "Stop alerting this room about changes to the TAC case")
+def send_unwatch(ctx):
+    # Find case numbers
+    case_numbers = ctx.case_numbers
+    if not case_numbers:
+        return "Invalid case number"
+
+    messages = []
+    for case_number in case_numbers:
+        if case_monitor.unwatch(case_number, ctx.room_id):
+            messages.append("Stopped watching SR {}".format(case_number))
+        else:
+            messages.append("SR {} is not being watched in this room".format(case_number))
+    return "<br>".join(messages)
 
 
 # Invite user by email or keyword
-def send_invite(post_data):
+@bot_command("/invite", "Invite new user to room by email (or keywords: cse=case owner)")
+def send_invite(ctx):
     # Determine the Spark Room to send reply to
-    room_id = post_data["data"]["roomId"]
-
-    message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/invite ", message_in.text)
+    room_id = ctx.room_id
+    content = ctx.argument
 
     # Check for keywords
     if content == "cse" or content == "CSE":
-        case_number = get_case_number(content, room_id)
-        case = CaseDetail(get_case_details(case_number))
+        case_number = ctx.case_number
+        case = get_case_details(case_number)
         if case.count > 0:
             owner_email = case.owner_email
             owner_first = case.owner_first
@@ -949,6 +964,7 @@ def send_invite(post_data):
 '''
 # last-note in caseAPIv3 returns entire email threads and is too long for Spark
 # removing from new version
+# @bot_command("/last-note", "Sends the contents of the last note attached to the case")
 def send_last_note(post_data):
     """
     Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
@@ -956,8 +972,7 @@ def send_last_note(post_data):
     """
     # Check if user is cisco.com
     person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
+    if not check_cisco_person(person_id):
         return "Sorry, CASE API access is limited to Cisco Employees for the time being"
 
     # Determine the Spark Room to send reply to
@@ -973,7 +988,7 @@ def send_last_note(post_data):
 
     if case_number:
         # Create case object
-        case = CaseDetail(get_case_details(case_number))
+        case = get_case_details(case_number)
         if not case.error:
             # Get case description
             n = case.last_note
@@ -995,6 +1010,7 @@ def send_last_note(post_data):
 # action plan never really worked properly :-( 
 # Case api v3 doesn't provide enough data types to capture action plan
 # removing from new version
+# @bot_command("/action-plan", "Sends the last note containing \"action plan\"")
 def send_action_plan(post_data):
     """
     Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
@@ -1002,8 +1018,7 @@ def send_action_plan(post_data):
     """
     # Check if user is cisco.com
     person_id = post_data["data"]["personId"]
-    email = get_email(person_id)
-    if not check_cisco_user(email):
+    if not check_cisco_person(person_id):
         return "Sorry, CASE API access is limited to Cisco Employees for the time being"
 
     # Determine the Spark Room to send reply to
@@ -1019,7 +1034,7 @@ def send_action_plan(post_data):
 
     if case_number:
         # Create case object
-        case = CaseDetail(get_case_details(case_number))
+        case = get_case_details(case_number)
         if case.count > 0:
             # Get case description
             n = case.action_plan
@@ -1041,14 +1056,16 @@ def send_action_plan(post_data):
 
 
 # Sample command function that just echos back the sent message
-def send_echo(incoming):
+# @bot_command("/echo", "Reply back with the same message sent.")
+def send_echo(ctx):
     # Get sent message
-    message = extract_message("/echo", incoming.text)
+    message = ctx.argument
     return message
 
 
 # Construct a help message for users.
-def send_help(post_data):
+@bot_command("/help", "Get help.")
+def send_help(ctx):
     message = "Hello!  "
     message = message + "I understand the following commands.  \n"
     message = message + "If case number is provided with the command, I will use that case number. \
@@ -1061,7 +1078,8 @@ def send_help(post_data):
 
 
 # Test command function that prints a test string
-def send_test():
+# @bot_command("/test", "Print test message.")
+def send_test(ctx):
     message = "This is a test message."
     return message
 
@@ -1070,7 +1088,17 @@ def send_test():
 # Bot functions
 #
 
-# Setup the Spark connection and WebHook
+# Person id and emails of the bot, resolved once at startup
+bot_identity = set()
+
+
+# Check if a person id or email belongs to the bot
+def is_bot(person_email=None, person_id=None):
+    return person_email in bot_identity or person_id in bot_identity
+
+
+# Set the Spark config details.  No requests are made to Spark here, the client is created on first use
+# and the bot identity and webhooks are set up by start_background_setup.
 def spark_setup(email, token):
     # Update the global variables for config details
     globals()["spark_token"] = token
@@ -1079,20 +1107,87 @@ def spark_setup(email, token):
     sys.stderr.write("Spark Bot Email: " + bot_email + "\n")
     sys.stderr.write("Spark Token: REDACTED\n")
 
-    # Setup the Spark Connection
-    globals()["spark"] = CiscoSparkAPI(access_token=globals()["spark_token"])
-    globals()["webhook"] = setup_webhook(globals()["bot_app_name"], globals()["bot_url"])
-    sys.stderr.write("Configuring Webhook. \n")
-    sys.stderr.write("Webhook ID: " + globals()["webhook"].id + "\n")
+    set_spark_token(token)
+    globals()["bot_identity"] = set([email])
+    startup.set_check("spark", None)
 
 
-if __name__ == '__main__':
-    # Entry point for bot
+# Resolve the bot identity, it is used to ignore the bot's own messages
+def resolve_bot_identity():
+    me = get_spark().people.me()
+    bot_identity.update([me.id] + list(me.emails))
+    sys.stderr.write("Spark Bot ID: " + me.id + "\n")
+
+
+# Create or update the message, room and membership webhooks
+def register_webhooks():
+    globals()["webhook"] = setup_webhook(bot_app_name, bot_url)
+    sys.stderr.write("Configuring Webhook. \n")
+    sys.stderr.write("Webhook ID: " + webhook.id + "\n")
+
+    # Room title changes invalidate the room cache
+    globals()["room_webhook"] = setup_webhook(bot_app_name + " rooms", bot_url, resource="rooms", event="updated")
+    sys.stderr.write("Room Webhook ID: " + room_webhook.id + "\n")
+
+    # Membership changes keep the case room index current
+    globals()["membership_webhook"] = setup_webhook(bot_app_name + " memberships", bot_url,
+                                                    resource="memberships", event="all")
+    sys.stderr.write("Membership Webhook ID: " + membership_webhook.id + "\n")
+
+
+# Seconds between attempts of the startup steps that failed, doubling up to STARTUP_RETRY_MAX
+STARTUP_RETRY_INTERVAL = float(os.environ.get("STARTUP_RETRY_INTERVAL", "5"))
+STARTUP_RETRY_MAX = float(os.environ.get("STARTUP_RETRY_MAX", "60"))
+
+
+# Run the startup steps, retrying those that fail, until every step has passed its readiness check
+def run_startup_steps(steps):
+    delay = STARTUP_RETRY_INTERVAL
+    while steps:
+        for step in list(steps):
+            name, function = step
+            try:
+                with startup.phase(name, check=name):
+                    function()
+                steps.remove(step)
+            except Exception as e:
+                sys.stderr.write("Startup step {} failed: {}\n".format(name, e))
+        if steps:
+            time.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX)
+    startup.log()
+
+
+# Resolve the bot identity, warm up the Case API token and register the webhooks in the background,
+# so the server accepts traffic right away; /ready reports when they are done.
+# The webhooks are registered by a single one of the processes forked from a server.
+def start_background_setup():
+    if spark_token is None:
+        return
+
+    steps = [("spark", resolve_bot_identity)]
+    if os.environ.get("CASE_API_CLIENT_ID"):
+        steps.append(("case_api_token", get_access_token))
+    if webhook_lock is None:
+        globals()["webhook_lock"] = try_server_lock("tacbot-webhooks")
+    if webhook_lock is not None:
+        steps.append(("webhooks", register_webhooks))
+
+    for name, function in steps:
+        startup.add_check(name)
+    thread = threading.Thread(target=run_startup_steps, args=(steps,), name="startup")
+    thread.daemon = True
+    thread.start()
+
+
+# Create the bot from the configuration in the environment.
+# Production WSGI servers load this through wsgi.py, the development server through __main__.
+def create_app():
     # Retrieve needed details from environment for the bot
-    bot_email = os.getenv("SPARK_BOT_EMAIL")
-    spark_token = os.getenv("SPARK_BOT_TOKEN")
-    bot_url = os.getenv("SPARK_BOT_URL")
-    bot_app_name = os.getenv("SPARK_BOT_APP_NAME")
+    globals()["bot_email"] = os.getenv("SPARK_BOT_EMAIL")
+    globals()["spark_token"] = os.getenv("SPARK_BOT_TOKEN")
+    globals()["bot_url"] = os.getenv("SPARK_BOT_URL")
+    globals()["bot_app_name"] = os.getenv("SPARK_BOT_APP_NAME")
 
     # bot_url and bot_app_name must come in from Environment Variables
     if bot_url is None or bot_app_name is None:
@@ -1102,15 +1197,49 @@ if __name__ == '__main__':
     sys.stderr.write("Spark Bot URL (for webhook): " + bot_url + "\n")
     sys.stderr.write("Spark Bot App Name: " + bot_app_name + "\n")
 
-    # Placeholder variables for spark connection objects
-    spark = None
-    webhook = None
+    # The bot is not ready until Spark is configured
+    startup.add_check("spark")
 
     # Check if the token and email were set in ENV
     if spark_token is None or bot_email is None:
         sys.stderr.write("Spark Config is missing, please provide via API.  Bot not ready.\n")
     else:
         spark_setup(bot_email, spark_token)
-        spark = CiscoSparkAPI(access_token=spark_token)
 
-    app.run(debug=True, host='0.0.0.0', port=int("5001"))
+    startup.mark("create_app")
+    return app
+
+
+# Reset per-process state in a server process forked after create_app, so workers don't share
+# connections or file handles with the parent, then run the startup steps
+def init_worker():
+    reset_connections()
+    globals()["webhook_dedupe"] = create_dedupe_store()
+
+    # With a shared watch list, every process is ready to take over polling
+    if case_monitor.path:
+        case_monitor.start()
+
+    start_background_setup()
+
+
+# Placeholder variables for config details and spark connection objects
+bot_email = None
+spark_token = None
+bot_url = None
+bot_app_name = None
+webhook = None
+webhook_lock = None
+
+startup.mark("import")
+
+
+if __name__ == '__main__':
+    # Entry point for the development server, use wsgi.py in production
+    create_app()
+    start_background_setup()
+
+    # Exit cleanly on SIGTERM so queued webhooks are drained
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    app.run(debug=os.getenv("BOT_DEBUG") == "true", threaded=True, host='0.0.0.0', port=int(os.getenv("PORT", "5001")))
@@ -0,0 +1,94 @@
+"""
+cache.py contains the in-memory caches used by bot.py and utilities.py
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# Time-to-live cache with LRU eviction by entry count and (estimated) memory use
+class TTLCache(object):
+    def __init__(self, ttl, max_entries, max_bytes=None, sizeof=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 1)
+        self._entries = OrderedDict()   # key -> (value, stored_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get_entry(key, count=False) is not None
+
+    # Return (value, stored_at) for a live entry, or None
+    def get_entry(self, key, count=True):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and time.time() - entry[1] >= self.ttl:
+                self._bytes -= entry[2]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            if count:
+                self.hits += 1
+            return entry[0], entry[1]
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def set(self, key, value, stored_at=None):
+        size = self._sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, stored_at or time.time(), size)
+            self._bytes += size
+
+            # Evict least recently used entries until both bounds are met
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.evictions += 1
+
+    # Mark an entry as stale so the next lookup refetches it
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+            return entry is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
@@ -1,133 +1,86 @@
 import re
+import sys
+import time
+from datetime import datetime
 
-# Case API wrapper class
-class CaseDetail(object):
-    def __init__(self, json):
-        self._json = json
-        super(CaseDetail, self).__init__()
-
-    '''
-    # Count doesn't exist in case api v3
-    # replaced with error
-    @property
-    def count(self):
-        return self._json['RESPONSE']['COUNT']
-    '''
-
-    @property
-    def error(self):
-        try:
-            return self._json['caseDetail']['ErrorResponse']['APIError']['ErrorDescription']
-        except:
-            return None
-
-    @property
-    def title(self):
-        return self._json['caseDetail']['title']
-
-    '''
-    # Problem description doesn't exist in case api v3
-    @property
-    def description(self):
-        return self._json['RESPONSE']['CASES']['CASE_DETAIL']['PROBLEM_DESC']
-    '''
+# Case API v3 date formats
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ')
 
-    @property
-    def serial(self):
-        return self._json['caseDetail']['serial_number']
-
-    '''
-    # hostname doesn't exist in case api v3
-    @property
-    def hostname(self):
+# CaseDetail attribute -> Case API v3 caseDetail key
+#
+# Not in case api v3: count (replaced with error), description (PROBLEM_DESC), hostname (DEVICE_NAME)
+# last-note in caseAPIv3 returns entire email threads and is too long for Spark
+# Case api v3 doesn't provide enough data types to capture action plan
+CASE_FIELDS = (
+    ('title', 'title'),
+    ('serial', 'serial_number'),
+    ('contract', 'contract_id'),
+    ('updated', 'updated_date'),
+    ('created', 'creation_date'),
+    ('status', 'status'),
+    ('severity', 'severity'),
+    ('rmas', 'rmas'),
+    ('bugs', 'bugs'),
+    ('owner_name', 'owner_name'),
+    ('owner_email', 'owner_email'),
+    ('customer_name', 'contact_name'),
+    ('customer_id', 'contact_user_id'),
+    ('customer_email', 'contact_email_ids'),                 # LIST of emails
+    ('customer_business', 'contact_business_phone_numbers'),
+    ('customer_mobile', 'contact_mobile_phone_numbers')
+)
+
+
+# Parse a Case API date, or return None
+def parse_date(value):
+    for date_format in DATE_FORMATS:
         try:
-            return self._json['RESPONSE']['CASES']['CASE_DETAIL']['DEVICE_NAME']
-        except:
-            return None
-    '''
-
-    @property
-    def contract(self):
-        return self._json['caseDetail']['contract_id']
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            pass
+    return None
 
-    @property
-    def updated(self):
-        return self._json['caseDetail']['updated_date']
-
-    @property
-    def created(self):
-        return self._json['caseDetail']['creation_date']
 
-    @property
-    def status(self):
-        return self._json['caseDetail']['status']
-
-    @property
-    def severity(self):
-        return self._json['caseDetail']['severity']
-
-    @property
-    def rmas(self):
-        return self._json['caseDetail']['rmas']
-
-    @property
-    def bugs(self):
-        return self._json['caseDetail']['bugs']
-
-    @property
-    def owner_name(self):
-        return self._json['caseDetail']['owner_name']
-
-    @property
-    def owner_email(self):
-        return self._json['caseDetail']['owner_email']
-
-    @property
-    def customer_name(self):
-        return self._json['caseDetail']['contact_name']
-
-    @property
-    def customer_id(self):
-        return self._json['caseDetail']['contact_user_id']
-
-    @property
-    def customer_email(self):
-        # Returns LIST of emails
-        return self._json['caseDetail']['contact_email_ids']
-
-    @property
-    def customer_business(self):
-        return self._json['caseDetail']['contact_business_phone_numbers']
-
-    @property
-    def customer_mobile(self):
-        return self._json['caseDetail']['contact_mobile_phone_numbers']
-
-    '''
-    # last-note in caseAPIv3 returns entire email threads and is too long for Spark
-    # removing from new version
-    @property
-    def last_note(self):
-        old_list = self._json['caseDetail']['notes']
-        new_list = sorted(old_list, key=lambda k: k['creation_date'])
-        return Note(new_list[-1])
-    '''
+# Case API wrapper class
+# The case details are read once from the Case API JSON: dates are parsed to datetimes and lists stored as
+# tuples.  The JSON itself is only kept with keep_json=True.  fetched_at is when the details were fetched from the
+# Case API, which is now unless the case was read back from a store.
+class CaseDetail(object):
+    __slots__ = ('error', 'created_at', 'updated_at', 'fetched_at', 'json') + tuple(attribute for attribute, key in CASE_FIELDS)
 
-    '''
-    # action plan never really worked properly :-( 
-    # Case api v3 doesn't provide enough data types to capture action plan
-    # removing from new version
-    @property
-    def action_plan(self):
-        _pattern = re.compile("action\ +plan", flags=re.IGNORECASE)
-        old_list = self._json['RESPONSE']['CASES']['CASE_DETAIL']['NOTES']['XXCTS_SCM_APIX_NOTE']
+    def __init__(self, json, keep_json=False, fetched_at=None):
+        detail = (json or {}).get('caseDetail') or {}
         try:
-            new_list = [n for n in old_list if _pattern.search(n['NOTE']) or _pattern.search(n['NOTE_DETAIL'])]
-            sorted_list = sorted(new_list, key=lambda k: k['CREATION_DATE'])
-            return Note(sorted_list[-1])
-        except:
-            return None
-    '''
+            self.error = detail['ErrorResponse']['APIError']['ErrorDescription']
+        except (KeyError, TypeError):
+            self.error = None
+
+        for attribute, key in CASE_FIELDS:
+            value = detail.get(key)
+            setattr(self, attribute, tuple(value) if isinstance(value, list) else value)
+
+        self.created_at = parse_date(self.created)
+        self.updated_at = parse_date(self.updated)
+        self.fetched_at = fetched_at or time.time()
+        self.json = json if keep_json else None
+
+    # The Case API JSON of the fields kept, e.g. to store the case and read it back with CaseDetail(json)
+    def to_json(self):
+        detail = {}
+        for attribute, key in CASE_FIELDS:
+            value = getattr(self, attribute)
+            detail[key] = list(value) if isinstance(value, tuple) else value
+        return {'caseDetail': detail}
+
+    # Approximate memory used by the case, for the case cache size limit
+    def __sizeof__(self):
+        size = object.__sizeof__(self)
+        for attribute in self.__slots__:
+            value = getattr(self, attribute)
+            size += sys.getsizeof(value)
+            if isinstance(value, tuple):
+                size += sum(sys.getsizeof(item) for item in value)
+        return size
 
     # get last note
     # get note by date
@@ -150,4 +103,4 @@ class Note(object):
     @property
     def creation_date(self):
         return self._json['creation_date']
-'''
\ No newline at end of file
+'''
@@ -0,0 +1,226 @@
+"""
+case_store.py contains the optional SQLite store used by utilities.py to keep case details and room titles
+across restarts
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+
+# Case details and room titles in a SQLite file, so a restarted process starts with a warm cache.
+# Rows are read on demand, writes are queued and written in the background, and rows keep the time they
+# were fetched, so cache TTLs carry over restarts.  Server processes on one host can share the file: rows
+# invalidated by one process are logged, and the others drop them from their memory caches when they sync.
+class SqliteCaseStore(object):
+    TABLES = ("cases", "rooms")
+    INVALIDATION_TTL = 3600
+
+    def __init__(self, path, ttls, max_bytes, flush_interval=1.0, compact_interval=300):
+        self.path = path
+        self.ttls = ttls                    # table -> seconds rows are kept
+        self.max_bytes = max_bytes          # compaction drops the oldest rows above this much data
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self._pending = {}                  # (table, key) -> (data, stored_at), or None to delete
+        self._invalidated = []              # (table, key) to log for the other processes
+        self._last_invalidation = 0         # id of the last logged invalidation seen by this process
+        self._listeners = []                # called with (table, key) for rows invalidated by other processes
+        self._origin = None                 # tells this process's invalidations from the others'
+        self._pid = None
+        self._conn = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._conn_lock = threading.Lock()
+        self._last_compact = time.time()
+
+        self.reads = 0
+        self.writes = 0
+        self.compacted = 0
+
+    # Connections and the writer thread are opened on first use in each process, as SQLite connections
+    # must not be shared with a forked process
+    def _connect(self):
+        if self._pid == os.getpid():
+            return self._conn
+        with self._lock:
+            if self._pid != os.getpid():
+                conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("PRAGMA journal_mode=WAL")
+                for table in self.TABLES:
+                    conn.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                                 "stored_at REAL NOT NULL)".format(table))
+                    conn.execute("CREATE INDEX IF NOT EXISTS {0}_stored_at_idx ON {0} (stored_at)".format(table))
+                conn.execute("CREATE TABLE IF NOT EXISTS invalidations (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                             "tbl TEXT NOT NULL, key TEXT NOT NULL, origin TEXT NOT NULL, at REAL NOT NULL)")
+                self._conn = conn
+                self._pending = {}
+                self._invalidated = []
+                self._origin = "{}:{}".format(os.getpid(), id(self))
+                # Rows invalidated before this process started are not in its memory caches
+                self._last_invalidation = conn.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+                self._conn_lock = threading.Lock()
+                self._writer = threading.Thread(target=self._run, name="case-store")
+                self._writer.daemon = True
+                self._writer.start()
+                self._pid = os.getpid()
+        return self._conn
+
+    # Return (data, stored_at) for a row younger than the table's TTL, or None
+    def get(self, table, key):
+        conn = self._connect()
+        with self._lock:
+            queued = (table, key) in self._pending
+            row = self._pending.get((table, key))
+        if not queued:
+            with self._conn_lock:
+                self.reads += 1
+                found = conn.execute("SELECT data, stored_at FROM {} WHERE key = ?".format(table), (key,)).fetchone()
+            if found is not None:
+                row = (json.loads(found[0]), found[1])
+        if row is None or time.time() - row[1] >= self.ttls[table]:
+            return None
+        return row
+
+    # Queue a row to be written
+    def put(self, table, key, data, stored_at=None):
+        self._connect()
+        with self._lock:
+            self._pending[(table, key)] = (data, stored_at or time.time())
+
+    # Queue a row to be deleted
+    def delete(self, table, key):
+        self._connect()
+        with self._lock:
+            self._pending[(table, key)] = None
+
+    # Queue a row to be deleted, and the other processes sharing the file to drop it from memory
+    def invalidate(self, table, key):
+        self._connect()
+        with self._lock:
+            self._pending[(table, key)] = None
+            self._invalidated.append((table, key))
+
+    # Call listener(table, key) for each row invalidated by another process
+    def on_invalidate(self, listener):
+        self._listeners.append(listener)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                self.sync()
+                if time.time() - self._last_compact >= self.compact_interval:
+                    self.compact()
+            except Exception:
+                sys.stderr.write("Case store write failed:\n{}".format(traceback.format_exc()))
+
+    # Write the queued rows in one transaction
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            pending = self._pending
+            invalidated = self._invalidated
+            self._pending = {}
+            self._invalidated = []
+        if not pending and not invalidated:
+            return
+        with self._conn_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for (table, key), row in pending.items():
+                    if row is None:
+                        self._conn.execute("DELETE FROM {} WHERE key = ?".format(table), (key,))
+                    else:
+                        self._conn.execute("INSERT OR REPLACE INTO {} (key, data, stored_at) VALUES (?, ?, ?)"
+                                           .format(table), (key, json.dumps(row[0]), row[1]))
+                self._conn.executemany("INSERT INTO invalidations (tbl, key, origin, at) VALUES (?, ?, ?, ?)",
+                                       [(table, key, self._origin, time.time()) for table, key in invalidated])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                # Keep the rows for the next flush, unless they were replaced meanwhile
+                with self._lock:
+                    for item in pending.items():
+                        self._pending.setdefault(*item)
+                    self._invalidated[:0] = invalidated
+                raise
+            self.writes += len(pending)
+
+    # Pass the rows invalidated by other processes since the last sync to the listeners
+    def sync(self):
+        if self._pid != os.getpid():
+            return
+        with self._conn_lock:
+            rows = self._conn.execute("SELECT id, tbl, key, origin FROM invalidations WHERE id > ? ORDER BY id",
+                                      (self._last_invalidation,)).fetchall()
+        for row_id, table, key, origin in rows:
+            self._last_invalidation = row_id
+            if origin != self._origin:
+                for listener in self._listeners:
+                    listener(table, key)
+
+    # Delete expired rows, then the oldest rows until the data fits in max_bytes, and give the space back
+    def compact(self):
+        self._connect()
+        self._last_compact = time.time()
+        with self._conn_lock:
+            self._conn.execute("DELETE FROM invalidations WHERE at <= ?", (time.time() - self.INVALIDATION_TTL,))
+            deleted = 0
+            for table in self.TABLES:
+                deleted += self._conn.execute("DELETE FROM {} WHERE stored_at <= ?".format(table),
+                                              (time.time() - self.ttls[table],)).rowcount
+            size = self.size()
+            while size > self.max_bytes:
+                # Drop the oldest tenth of the rows, across both tables
+                oldest = self._conn.execute("SELECT stored_at FROM (SELECT stored_at FROM cases UNION ALL "
+                                            "SELECT stored_at FROM rooms) ORDER BY stored_at LIMIT 1 OFFSET "
+                                            "(SELECT (COUNT(*) - 1) / 10 FROM (SELECT key FROM cases UNION ALL "
+                                            "SELECT key FROM rooms))").fetchone()
+                if oldest is None:
+                    break
+                for table in self.TABLES:
+                    deleted += self._conn.execute("DELETE FROM {} WHERE stored_at <= ?".format(table),
+                                                  oldest).rowcount
+                size = self.size()
+            if deleted:
+                self._conn.execute("PRAGMA incremental_vacuum")
+                self.compacted += deleted
+        return deleted
+
+    # Bytes of case and room data in the store
+    def size(self):
+        return sum(self._conn.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM {}".format(table)).fetchone()[0]
+                   for table in self.TABLES)
+
+    # Write the queued rows, e.g. before the process exits
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "invalidations": self._last_invalidation,
+            "reads": self.reads,
+            "writes": self.writes,
+            "compacted": self.compacted
+        }
+
+
+# Create the case store configured in the environment, or None if CASE_STORE_PATH is not set.
+# ttls is table -> seconds, normally the TTLs of the matching in-memory caches.
+def create_case_store(ttls):
+    path = os.environ.get("CASE_STORE_PATH")
+    if not path:
+        return None
+    return SqliteCaseStore(path, ttls,
+                           max_bytes=int(os.environ.get("CASE_STORE_MAX_BYTES", str(64 * 1024 * 1024))),
+                           flush_interval=float(os.environ.get("CASE_STORE_FLUSH_INTERVAL", "1")),
+                           compact_interval=float(os.environ.get("CASE_STORE_COMPACT_INTERVAL", "300")))
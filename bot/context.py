@@ -0,0 +1,43 @@
+"""
+context.py contains the per-webhook request context passed to the command functions in bot.py
+"""
+
+from utilities import get_room_case_numbers
+
+
+# Everything a command function needs to know about the message it is replying to.
+# Built once per webhook from the parsed message, so the message is only fetched from Spark and parsed once.
+class RequestContext(object):
+    def __init__(self, post_data, message, parsed):
+        self.post_data = post_data
+        self.message = message
+        self.message_id = post_data["data"]["id"]
+        self.room_id = post_data["data"]["roomId"]
+        self.person_id = post_data["data"]["personId"]
+        self.person_email = message.personEmail
+        self.command = parsed.command
+
+        # Text following the command, or the whole message when no command was found
+        self.argument = parsed.argument
+
+        self.parsed = parsed
+        self._case_numbers = None
+
+    # Email addresses in the argument, found on first use
+    @property
+    def emails(self):
+        return self.parsed.emails
+
+    # Case numbers from the command argument, or from the room title; resolved on first use
+    @property
+    def case_numbers(self):
+        if self._case_numbers is None:
+            self._case_numbers = self.parsed.case_numbers or get_room_case_numbers(self.room_id)
+        return self._case_numbers
+
+    # The first case number, or False if there is none
+    @property
+    def case_number(self):
+        if self.case_numbers:
+            return self.case_numbers[0]
+        return False
@@ -0,0 +1,96 @@
+"""
+dedupe.py contains the stores used by bot.py to drop webhooks that Spark delivers more than once
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Remembers ids seen in the last `window` seconds, in memory
+class MemoryDedupeStore(object):
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # id -> seen_at, oldest first
+        self._lock = threading.Lock()
+
+    # Record the id; returns True if it was already seen within the window
+    def seen(self, key):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return False
+
+    # Forget an id, e.g. when its webhook could not be queued and should be accepted on redelivery
+    def forget(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def _purge(self, now):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.window:
+                break
+            del self._seen[key]
+
+    def __len__(self):
+        return len(self._seen)
+
+
+# Remembers ids seen in the last `window` seconds in a SQLite file, so replicas on one host can share it
+class SqliteDedupeStore(object):
+    # Expired rows are deleted once every PURGE_INTERVAL inserts
+    PURGE_INTERVAL = 100
+
+    def __init__(self, path, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS seen_at_idx ON seen (seen_at)")
+
+    # Record the id; returns True if it was already seen within the window
+    def seen(self, key):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM seen WHERE id = ? AND seen_at <= ?", (key, now - self.window))
+                cursor = self._conn.execute("INSERT OR IGNORE INTO seen (id, seen_at) VALUES (?, ?)", (key, now))
+                duplicate = cursor.rowcount == 0
+                if not duplicate:
+                    self._inserts += 1
+                    if self._inserts % self.PURGE_INTERVAL == 0:
+                        self._conn.execute("DELETE FROM seen WHERE seen_at <= ?", (now - self.window,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return duplicate
+
+    def forget(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM seen WHERE id = ?", (key,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+
+# Create the dedupe store configured in the environment
+def create_dedupe_store():
+    window = int(os.environ.get("WEBHOOK_DEDUPE_WINDOW", "600"))
+    path = os.environ.get("WEBHOOK_DEDUPE_PATH")
+    if path:
+        return SqliteDedupeStore(path, window)
+    return MemoryDedupeStore(window, int(os.environ.get("WEBHOOK_DEDUPE_MAX_ENTRIES", "10000")))
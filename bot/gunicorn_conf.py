@@ -0,0 +1,43 @@
+"""
+gunicorn_conf.py contains the gunicorn settings for running the bot in production, see wsgi.py
+"""
+
+import os
+
+# Load wsgi.py and the bot modules from this directory
+chdir = os.path.dirname(os.path.abspath(__file__))
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+workers = int(os.environ.get("BOT_WORKERS", "2"))
+# Tell the bot how many workers share its state
+os.environ["BOT_WORKERS"] = str(workers)
+threads = int(os.environ.get("BOT_THREADS", "8"))
+worker_class = "gthread"
+timeout = int(os.environ.get("BOT_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("BOT_GRACEFUL_TIMEOUT", "30"))
+
+# Spark sends each webhook to a single worker, so with several workers the state that webhooks and commands
+# change is kept in files they all share, unless set otherwise: the message ids already seen, the room index,
+# the watched cases, and the case and room title store, through which /refresh and room title updates reach
+# every worker's cache
+if workers > 1:
+    os.environ.setdefault("WEBHOOK_DEDUPE_PATH", "/tmp/tacbot-dedupe.db")
+    os.environ.setdefault("CASE_STORE_PATH", "/tmp/tacbot-cases.db")
+    os.environ.setdefault("ROOM_INDEX_PATH", "/tmp/tacbot-rooms.db")
+    os.environ.setdefault("CASE_WATCH_PATH", "/tmp/tacbot-watches.json")
+
+# Load the app once in the master, without any requests to Spark.
+# Per-worker state is then reset in post_fork, and each worker runs the startup steps in the background;
+# the Spark webhooks are registered by one of the workers only.
+preload_app = True
+
+
+def post_fork(server, worker):
+    import bot
+    bot.init_worker()
+
+
+# Finish processing queued webhooks before the worker exits
+def worker_exit(server, worker):
+    import bot
+    bot.shutdown_workers()
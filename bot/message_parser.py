@@ -0,0 +1,74 @@
+"""
+message_parser.py contains the message parser, which finds the command, case numbers and emails in a message
+"""
+
+import re
+
+# Each token regex starts with a literal character, which lets the regex engine skip straight to the
+# candidates; on large pasted logs this is several times faster than scanning once with an alternation.
+
+# A /command word, at the start of the text or after whitespace
+command_regex = re.compile(r"/(?<!\S/)[\w-]+")
+
+# A 9 digit case number starting with 6, not part of a longer number or an email address
+case_number_regex = re.compile(r"6(?<!\d6)\d{8}(?![\d@])")
+
+# The "@" and domain of an email address, and the local part before the "@"
+email_domain_regex = re.compile(r"@[\w\-]+(?:\.[\w\-]+)*\.[a-zA-Z]{2,5}(?![\w\-])")
+email_local_regex = re.compile(r"(?<![\w.\-])[\w.\-]{1,64}$")
+
+email_syntax_regex = re.compile(r"^([a-zA-Z0-9_\-\.]+)@([a-zA-Z0-9_\-\.]+)\.([a-zA-Z]{2,5})$")
+cisco_email_regex = re.compile(r"^([a-zA-Z0-9_\-\.]+)@(cisco)\.(com)$")
+
+
+# The parts of a message the bot acts on
+class ParsedMessage(object):
+    __slots__ = ("text", "command", "argument", "case_numbers", "_argument_start", "_emails")
+
+    def __init__(self, text, command, argument_start, case_numbers):
+        self.text = text
+        self.command = command              # "" when no known command was sent
+        self.argument = text[argument_start:].strip()   # text following the command, or the whole text
+        self.case_numbers = case_numbers    # case numbers in the argument, in order and without duplicates
+        self._argument_start = argument_start
+        self._emails = None
+
+    # Email addresses in the argument, in order and without duplicates.
+    # Only a few commands use them, so they are found on first use.
+    @property
+    def emails(self):
+        if self._emails is None:
+            self._emails = find_emails(self.text, self._argument_start)
+        return self._emails
+
+
+# Remove duplicates, keeping the first occurrence of each token
+def unique(tokens):
+    seen = set()
+    return [t for t in tokens if not (t in seen or seen.add(t))]
+
+
+# Find the email addresses in text[start:]
+def find_emails(text, start=0):
+    emails = []
+    for match in email_domain_regex.finditer(text, start):
+        at = match.start()
+        local = email_local_regex.search(text, max(start, at - 64), at)
+        if local is not None:
+            emails.append(local.group() + match.group())
+    return unique(emails)
+
+
+# Parse a message; the first /command word is the command if it is one of `commands`.
+# Case numbers and emails are only taken from the text following the command.
+def parse_message(text, commands=()):
+    text = text or ""
+    command = ""
+    start = 0
+
+    match = command_regex.search(text)
+    if match and match.group() in commands:
+        command = match.group()
+        start = match.end()
+
+    return ParsedMessage(text, command, start, unique(case_number_regex.findall(text, start)))
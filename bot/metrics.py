@@ -0,0 +1,163 @@
+"""
+metrics.py contains the counters and histograms exposed in Prometheus text format on /metrics
+"""
+
+import bisect
+import threading
+from tracing import record_span
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in pairs) + "}"
+
+
+# Monotonic counter, with one value per combination of label values
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, **kwargs):
+        amount = kwargs.get("amount", 1)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _format_labels(self.label_names, labels), value) for labels, value in sorted(values)]
+
+
+# Histogram of observed values, with one set of buckets per combination of label values
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        samples = []
+        for labels, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", _format_labels(self.label_names, labels, ("le", repr(bound))),
+                                cumulative))
+            samples.append((self.name + "_bucket", _format_labels(self.label_names, labels, ("le", "+Inf")), counts[-1]))
+            samples.append((self.name + "_sum", _format_labels(self.label_names, labels), counts[-2]))
+            samples.append((self.name + "_count", _format_labels(self.label_names, labels), counts[-1]))
+        return samples
+
+
+# Metric whose values are read from a function when metrics are scraped, so it costs nothing until then.
+# The function returns a list of (label values, value).
+class Collector(object):
+    def __init__(self, name, help_text, label_names, function, metric_type="gauge"):
+        self.type = metric_type
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._function = function
+
+    def samples(self):
+        return [(self.name, _format_labels(self.label_names, labels), value) for labels, value in self._function()]
+
+
+# The metrics of this process
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def collector(self, name, help_text, label_names, function, metric_type="gauge"):
+        return self.register(Collector(name, help_text, label_names, function, metric_type))
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+webhooks = registry.counter("tacbot_webhooks_total", "Webhooks received, by resource and result",
+                            ["resource", "result"])
+command_duration = registry.histogram("tacbot_command_duration_seconds", "Time to build the reply to a command",
+                                      ["command"])
+command_errors = registry.counter("tacbot_command_errors_total", "Commands that raised an error", ["command"])
+upstream_duration = registry.histogram("tacbot_upstream_duration_seconds", "Latency of requests to Spark, Case API and SSO",
+                                       ["upstream", "endpoint"])
+upstream_errors = registry.counter("tacbot_upstream_errors_total", "Failed requests to Spark, Case API and SSO",
+                                   ["upstream", "endpoint"])
+case_lookups = registry.counter("tacbot_case_lookups_total", "Case lookups, by the state of the cached details",
+                                ["state"])
+coalesced_calls = registry.counter("tacbot_coalesced_calls_total",
+                                   "Calls that shared the result of an identical call in flight", ["call"])
+outbound_messages = registry.counter("tacbot_outbound_messages_total", "Messages posted to Spark, by result",
+                                     ["result"])
+
+
+# Return a requests response hook recording latency and errors, and a span in the current trace.
+# classify(method, url) returns the (upstream, endpoint) labels of a request.
+def upstream_hook(classify):
+    def record(response, *args, **kwargs):
+        upstream, endpoint = classify(response.request.method, response.request.url)
+        elapsed = response.elapsed.total_seconds()
+        upstream_duration.observe(elapsed, upstream, endpoint)
+        record_span("{} {}".format(upstream, endpoint), elapsed)
+        if response.status_code >= 400:
+            upstream_errors.inc(upstream, endpoint)
+        return response
+    return record
+
+
+# Add the upstream latency hook to a requests session
+def instrument_session(session, classify):
+    session.hooks["response"].append(upstream_hook(classify))
+    return session
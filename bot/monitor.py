@@ -0,0 +1,314 @@
+"""
+monitor.py contains the background case monitor, which polls watched cases and alerts rooms when they change
+"""
+
+import fcntl
+import heapq
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from ratelimit import TokenBucket
+
+# Fields compared between two polls of a case, as (label, CaseDetail property)
+WATCHED_FIELDS = [
+    ("Status", "status"),
+    ("Severity", "severity"),
+    ("Owner", "owner_name"),
+    ("RMAs", "rmas"),
+    ("Bugs", "bugs"),
+    ("Last update", "updated")
+]
+
+# Seconds between polls, by severity; closed cases are polled rarely
+POLL_INTERVALS = {
+    "1": int(os.environ.get("MONITOR_INTERVAL_SEV1", "120")),
+    "2": int(os.environ.get("MONITOR_INTERVAL_SEV2", "300")),
+    "3": int(os.environ.get("MONITOR_INTERVAL_SEV3", "1800")),
+    "4": int(os.environ.get("MONITOR_INTERVAL_SEV4", "3600"))
+}
+POLL_INTERVAL_CLOSED = int(os.environ.get("MONITOR_INTERVAL_CLOSED", "21600"))
+POLL_INTERVAL_ERROR = int(os.environ.get("MONITOR_INTERVAL_ERROR", "600"))
+
+
+# Return the watched fields of a case
+def case_snapshot(case):
+    return dict((field, getattr(case, field)) for label, field in WATCHED_FIELDS)
+
+
+# Return the (label, old value, new value) of every watched field that changed
+def diff_snapshots(old, new):
+    return [(label, old.get(field), new.get(field)) for label, field in WATCHED_FIELDS
+            if old.get(field) != new.get(field)]
+
+
+# Format the changes to a case as a markdown alert
+def format_changes(case_number, changes):
+    message = "Changes to SR {}:\n".format(case_number)
+    for label, old, new in changes:
+        if isinstance(new, tuple):
+            added = [x for x in new if x not in (old or ())]
+            removed = [x for x in (old or ()) if x not in new]
+            if added:
+                message = message + "* {} added: {}\n".format(label, ", ".join(str(x) for x in added))
+            if removed:
+                message = message + "* {} removed: {}\n".format(label, ", ".join(str(x) for x in removed))
+        else:
+            message = message + "* {}: {} -> **{}**\n".format(label, old, new)
+    return message
+
+
+# Seconds until a case should be polled again, based on its status and severity
+def poll_interval(snapshot):
+    if "Closed" in (snapshot.get("status") or ""):
+        return POLL_INTERVAL_CLOSED
+    return POLL_INTERVALS.get(str(snapshot.get("severity"))[:1], POLL_INTERVALS["3"])
+
+
+# A watched case: the rooms to alert, the last snapshot and the time of the next poll
+class Watch(object):
+    def __init__(self, case_number):
+        self.case_number = case_number
+        self.rooms = set()
+        self.snapshot = None
+        self.due = None
+
+
+# Polls watched cases in the background and posts their changes to the watching rooms.
+#
+# Polls are jittered and rate limited, and every case due within `wave_window` seconds is polled in
+# the same wave.  When `path` is set the watch list is saved to that JSON file, so every server
+# process sees the same watches, and a lock file makes sure only one process polls them.
+class CaseMonitor(object):
+    def __init__(self, fetch, notify, path=None, polls_per_second=2.0, wave_window=10.0, jitter=0.1):
+        self._fetch = fetch         # case_number -> CaseDetail, bypassing caches
+        self._notify = notify       # (room_id, markdown) -> None
+        self.path = path
+        self.wave_window = wave_window
+        self.jitter = jitter
+        self._rate_limit = TokenBucket(polls_per_second)
+        self._watches = {}          # case_number -> Watch
+        self._schedule = []         # heap of (due, case_number)
+        self._cond = threading.Condition()
+        self._mtime = None
+        self._lock_file = None
+        self._thread = None
+        self._stopped = False
+
+        self.polls = 0
+        self.alerts = 0
+        self.errors = 0
+
+    #
+    # Watch list
+    #
+
+    def watch(self, case_number, room_id):
+        with self._file_lock():
+            with self._cond:
+                self._reload_if_changed()
+                self._add(case_number, room_id)
+                self._save()
+                self._cond.notify()
+        self.start()
+
+    # Stop alerting a room about a case; returns False if the room was not watching it
+    def unwatch(self, case_number, room_id):
+        with self._file_lock():
+            with self._cond:
+                self._reload_if_changed()
+                watch = self._watches.get(case_number)
+                if watch is None or room_id not in watch.rooms:
+                    return False
+                watch.rooms.discard(room_id)
+                if not watch.rooms:
+                    del self._watches[case_number]
+                self._save()
+                return True
+
+    def watched_cases(self, room_id):
+        with self._cond:
+            self._reload_if_changed()
+            return sorted(c for c, w in self._watches.items() if room_id in w.rooms)
+
+    def __len__(self):
+        return len(self._watches)
+
+    def _add(self, case_number, room_id):
+        watch = self._watches.get(case_number)
+        if watch is None:
+            watch = self._watches[case_number] = Watch(case_number)
+            # Poll new cases right away, to take the baseline snapshot
+            self._schedule_poll(watch, time.time())
+        watch.rooms.add(room_id)
+
+    def _schedule_poll(self, watch, due):
+        watch.due = due
+        heapq.heappush(self._schedule, (due, watch.case_number))
+
+    # Serialize read-modify-write of the watch file between processes
+    def _file_lock(self):
+        return _FileLock(self.path + ".write-lock" if self.path else None)
+
+    def _reload_if_changed(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._mtime:
+            return
+        with open(self.path) as f:
+            rooms_by_case = json.load(f)["cases"]
+        for case_number in list(self._watches):
+            if case_number not in rooms_by_case:
+                del self._watches[case_number]
+        for case_number, rooms in rooms_by_case.items():
+            if case_number in self._watches:
+                self._watches[case_number].rooms = set(rooms)
+            else:
+                for room_id in rooms:
+                    self._add(case_number, room_id)
+        self._mtime = mtime
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {"cases": dict((c, sorted(w.rooms)) for c, w in self._watches.items())}
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+
+    #
+    # Scheduler
+    #
+
+    # The scheduler thread is started on first use, so each forked server process gets its own
+    def start(self):
+        with self._cond:
+            if self._thread is not None or self._stopped:
+                return
+            self._thread = threading.Thread(target=self._run, name="case-monitor")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    # Only one process polls when the watch list is shared; the others keep trying to take over
+    def _is_leader(self):
+        if not self.path:
+            return True
+        if self._lock_file is None:
+            lock_file = open(self.path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            sys.stderr.write("Case monitor polling in process {}\n".format(os.getpid()))
+        return True
+
+    # Wait for the next poll wave, and return the case numbers in it
+    def _next_wave(self):
+        with self._cond:
+            while not self._stopped:
+                self._reload_if_changed()
+                now = time.time()
+                if self._schedule and self._schedule[0][0] <= now:
+                    break
+                timeout = self._schedule[0][0] - now if self._schedule else 60
+                # Wake up at least once a minute to pick up watches added by other processes
+                self._cond.wait(min(timeout, 60))
+            if self._stopped:
+                return []
+
+            # Merge every case due within the wave window into this wave
+            wave = []
+            horizon = time.time() + self.wave_window
+            while self._schedule and self._schedule[0][0] <= horizon:
+                due, case_number = heapq.heappop(self._schedule)
+                watch = self._watches.get(case_number)
+                # Skip cases no longer watched, and schedule entries replaced by a newer one
+                if watch is not None and watch.due == due:
+                    wave.append(case_number)
+            return wave
+
+    def _run(self):
+        while not self._stopped:
+            if not self._is_leader():
+                time.sleep(30)
+                continue
+            for case_number in self._next_wave():
+                if self._stopped:
+                    return
+                self._rate_limit.acquire()
+                try:
+                    self._poll(case_number)
+                except Exception:
+                    self.errors += 1
+                    sys.stderr.write("Case monitor failed to poll SR {}:\n{}".format(case_number,
+                                                                                   traceback.format_exc()))
+                    with self._cond:
+                        watch = self._watches.get(case_number)
+                        if watch is not None:
+                            self._schedule_poll(watch, time.time() + POLL_INTERVAL_ERROR)
+
+    def _poll(self, case_number):
+        case = self._fetch(case_number)
+        self.polls += 1
+        if case.error:
+            raise ValueError(case.error)
+        snapshot = case_snapshot(case)
+
+        with self._cond:
+            watch = self._watches.get(case_number)
+            if watch is None:
+                return
+            old = watch.snapshot
+            watch.snapshot = snapshot
+            rooms = list(watch.rooms)
+            interval = poll_interval(snapshot)
+            self._schedule_poll(watch, time.time() + interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+        if old is None:
+            return
+        changes = diff_snapshots(old, snapshot)
+        if changes:
+            message = format_changes(case_number, changes)
+            for room_id in rooms:
+                self.alerts += 1
+                self._notify(room_id, message)
+
+    def stats(self):
+        return {
+            "watched": len(self._watches),
+            "scheduled": len(self._schedule),
+            "polls": self.polls,
+            "alerts": self.alerts,
+            "errors": self.errors
+        }
+
+
+# Exclusive lock on a file, used as a context manager; does nothing without a path
+class _FileLock(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if self.path:
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
@@ -0,0 +1,173 @@
+"""
+outbound.py contains the outbound queue used by bot.py to post messages to Spark in the background
+"""
+
+import sys
+import threading
+import time
+from collections import deque
+import requests
+from ciscosparkapi import SparkApiError
+from utilities import get_retry_after
+from metrics import outbound_messages
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Queued to stop a worker thread; a private object, so no message key can be mistaken for it
+_STOP = object()
+
+
+# Seconds to wait before retrying a failed send, or None if it should not be retried
+def retry_delay(error, attempt, backoff):
+    if isinstance(error, SparkApiError):
+        if error.response_code == 429:
+            delay = get_retry_after(error.response) if error.response is not None else None
+            return delay if delay is not None else backoff * (2 ** attempt)
+        if error.response_code < 500:
+            return None
+    elif not isinstance(error, requests.exceptions.RequestException):
+        return None
+    return backoff * (2 ** attempt)
+
+
+# Posts messages from a bounded queue with a pool of threads.
+# Messages with the same key (a room or person) are sent one at a time and in order, the keys take turns,
+# and every send takes a token from the shared rate limit.  A 429 pauses the rate limit for every key, since
+# Spark limits the bot as a whole.
+class OutboundQueue(object):
+    def __init__(self, send, rate_limit, num_workers, max_depth, max_retries=5, backoff=1.0, max_retry_delay=60,
+                 name="outbound"):
+        self._send = send
+        self.rate_limit = rate_limit
+        self.num_workers = num_workers
+        self.max_depth = max_depth
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_delay = max_retry_delay
+        self.name = name
+        self._pending = {}              # key -> deque of messages, the first one being sent
+        self._ready = queue.Queue()     # keys with messages to send, each key queued at most once
+        self._depth = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._accepting = True
+
+        self.accepted = 0
+        self.dropped = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    # Threads are started on first use, so each forked server process gets its own
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._run, name="{}-{}".format(self.name, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    # Queue a message without blocking; returns False if the queue is full or shutting down
+    def submit(self, key, message):
+        if self._accepting:
+            self.start()
+        with self._lock:
+            if not self._accepting or self._depth >= self.max_depth:
+                self.dropped += 1
+                outbound_messages.inc("dropped")
+                sys.stderr.write("{} queue full, dropping message to {}\n".format(self.name, key))
+                return False
+            self._depth += 1
+            self.accepted += 1
+            messages = self._pending.get(key)
+            if messages is None:
+                self._pending[key] = deque([message])
+                self._ready.put(key)
+            else:
+                messages.append(message)
+        return True
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            try:
+                if key is _STOP:
+                    return
+                with self._lock:
+                    message = self._pending[key][0]
+                self._deliver(key, message)
+                with self._lock:
+                    messages = self._pending[key]
+                    messages.popleft()
+                    self._depth -= 1
+                    # Go to the back of the line, so a busy room does not hold up the others
+                    if messages:
+                        self._ready.put(key)
+                    else:
+                        del self._pending[key]
+            finally:
+                self._ready.task_done()
+
+    # Send a message, retrying 429s after their Retry-After, and 5xx and connection errors with backoff
+    def _deliver(self, key, message):
+        attempt = 0
+        while True:
+            self.rate_limit.acquire()
+            try:
+                self._send(message)
+                self.sent += 1
+                outbound_messages.inc("sent")
+                return True
+            except Exception as e:
+                delay = retry_delay(e, attempt, self.backoff)
+                if delay is None or attempt >= self.max_retries:
+                    self.failed += 1
+                    outbound_messages.inc("failed")
+                    sys.stderr.write("{} failed to send message to {}: {}\n".format(self.name, key, e))
+                    return False
+                delay = min(delay, self.max_retry_delay)
+                sys.stderr.write("{} message to {} failed ({}), retrying in {:.1f}s\n".format(self.name, key, e, delay))
+                self.retried += 1
+                outbound_messages.inc("retried")
+                attempt += 1
+                if isinstance(e, SparkApiError) and e.response_code == 429:
+                    self.rate_limit.pause(delay)
+                else:
+                    time.sleep(delay)
+
+    # Stop accepting new messages, let the workers send the queued ones and wait for them to exit
+    def shutdown(self, timeout=None):
+        self._accepting = False
+        with self._lock:
+            threads = list(self._threads)
+            self._threads = []
+        if not threads:
+            return
+        sys.stderr.write("Sending {} queued {} messages.\n".format(self.depth(), self.name))
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.depth() and (deadline is None or time.time() < deadline):
+            time.sleep(0.05)
+        for t in threads:
+            self._ready.put(_STOP)
+        for t in threads:
+            t.join(max(0, deadline - time.time()) if deadline is not None else None)
+
+    def depth(self):
+        return self._depth
+
+    def stats(self):
+        return {
+            "workers": self.num_workers,
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "rooms": len(self._pending),
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed
+        }
@@ -0,0 +1,52 @@
+"""
+ratelimit.py contains the rate limiter shared by the background jobs and the outbound messages of the bot
+"""
+
+import threading
+import time
+
+
+# Token bucket allowing `rate` operations per second, with bursts of up to `capacity`
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    # Take a token if one is available; otherwise return the seconds until one will be
+    def try_acquire(self):
+        with self._lock:
+            now = time.time()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    # Block until a token is available
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    # Hand out no tokens for `seconds`, e.g. when the remote side asks to retry later.
+    # The bucket starts empty again once the pause is over.
+    def pause(self, seconds):
+        with self._lock:
+            until = time.time() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                self._tokens = 0.0
+                self._updated = until
@@ -0,0 +1,311 @@
+"""
+room_index.py contains the local index of case rooms used by utilities.py
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+# Index of case number -> roomIds -> member personIds, in memory.
+# Rooms without a case number are only counted, and the open/closed state of each case is kept for the counts.
+class RoomIndex(object):
+    def __init__(self):
+        self.built = False
+        self.rebuilt_at = 0
+        self._cases = {}    # case_number -> {roomId: set(personIds)}
+        self._rooms = {}    # roomId -> case_number
+        self._other_rooms = set()
+        self._closed = {}   # case_number -> True if closed, False if open
+        self._counts = None
+        self._lock = threading.RLock()
+
+    # Counts are recomputed after each change
+    def _changed(self):
+        self._counts = None
+
+    # Replace the index; rooms is an iterable of (roomId, case_number), members(roomId) returns personIds
+    def rebuild(self, rooms, members):
+        cases = {}
+        room_cases = {}
+        other_rooms = set()
+        for room_id, case_number in rooms:
+            if case_number:
+                cases.setdefault(case_number, {})[room_id] = set(members(room_id))
+                room_cases[room_id] = case_number
+            else:
+                other_rooms.add(room_id)
+        with self._lock:
+            self._cases = cases
+            self._rooms = room_cases
+            self._other_rooms = other_rooms
+            self._closed = dict((c, closed) for c, closed in self._closed.items() if c in cases)
+            self.built = True
+            self.rebuilt_at = time.time()
+            self._changed()
+
+    # Add a room; rooms without a case number are only counted
+    def add_room(self, room_id, case_number, members=()):
+        with self._lock:
+            if not case_number:
+                if room_id not in self._other_rooms:
+                    self._other_rooms.add(room_id)
+                    self._changed()
+                return
+            self._cases.setdefault(case_number, {}).setdefault(room_id, set()).update(members)
+            self._rooms[room_id] = case_number
+            self._changed()
+
+    def remove_room(self, room_id):
+        with self._lock:
+            if room_id in self._other_rooms:
+                self._other_rooms.discard(room_id)
+                self._changed()
+                return
+            case_number = self._rooms.pop(room_id, None)
+            if case_number is None:
+                return
+            self._cases[case_number].pop(room_id, None)
+            if not self._cases[case_number]:
+                del self._cases[case_number]
+                self._closed.pop(case_number, None)
+            self._changed()
+
+    def has_room(self, room_id):
+        with self._lock:
+            return room_id in self._rooms or room_id in self._other_rooms
+
+    # Add a member to a room already in the index; returns False for unknown rooms.
+    # Members of rooms without a case number are not tracked.
+    def add_member(self, room_id, person_id):
+        with self._lock:
+            if room_id in self._other_rooms:
+                return True
+            case_number = self._rooms.get(room_id)
+            if case_number is None:
+                return False
+            self._cases[case_number][room_id].add(person_id)
+            self._changed()
+            return True
+
+    def remove_member(self, room_id, person_id):
+        with self._lock:
+            case_number = self._rooms.get(room_id)
+            if case_number is not None:
+                self._cases[case_number][room_id].discard(person_id)
+                self._changed()
+
+    # Return the roomId of a room for case_number that person_id is a member of, or None
+    def find_room(self, case_number, person_id):
+        with self._lock:
+            for room_id, members in self._cases.get(case_number, {}).items():
+                if person_id in members:
+                    return room_id
+            return None
+
+    def rooms_for_case(self, case_number):
+        with self._lock:
+            return list(self._cases.get(case_number, {}))
+
+    # Record whether a case with rooms is closed; cases without rooms are ignored
+    def set_case_closed(self, case_number, closed):
+        with self._lock:
+            if case_number in self._cases and self._closed.get(case_number) != closed:
+                self._closed[case_number] = closed
+                self._changed()
+
+    # Case numbers whose open/closed state is not known, or that were open when last seen
+    def cases_not_closed(self):
+        with self._lock:
+            return [c for c in self._cases if not self._closed.get(c)]
+
+    # Room totals, by case rooms vs other rooms and open vs closed cases; kept until the index changes
+    def counts(self):
+        with self._lock:
+            if self._counts is None:
+                closed = sum(len(rooms) for c, rooms in self._cases.items() if self._closed.get(c) is True)
+                open_ = sum(len(rooms) for c, rooms in self._cases.items() if self._closed.get(c) is False)
+                self._counts = {
+                    "total": len(self._rooms) + len(self._other_rooms),
+                    "case_rooms": len(self._rooms),
+                    "other_rooms": len(self._other_rooms),
+                    "open_case_rooms": open_,
+                    "closed_case_rooms": closed,
+                    "unknown_case_rooms": len(self._rooms) - open_ - closed
+                }
+            return dict(self._counts)
+
+    # Number of case rooms
+    def __len__(self):
+        return len(self._rooms)
+
+
+# Index of case number -> roomIds -> member personIds in a SQLite file, shared by the server processes on a host
+# and kept across restarts.  Each change only writes the rows it touches, in a transaction, so concurrent
+# changes from several processes are all kept.
+class SqliteRoomIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        self._conn = None
+        self._counts = None
+        self._counts_version = None
+        self._lock = threading.RLock()
+
+    # Connections are opened on first use in each process, as SQLite connections must not be shared with a
+    # forked process
+    def _connect(self):
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS rooms (room_id TEXT PRIMARY KEY, case_number TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS rooms_case_number_idx ON rooms (case_number)")
+            conn.execute("CREATE TABLE IF NOT EXISTS members (room_id TEXT NOT NULL, person_id TEXT NOT NULL, "
+                         "PRIMARY KEY (room_id, person_id))")
+            conn.execute("CREATE INDEX IF NOT EXISTS members_person_id_idx ON members (person_id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cases (case_number TEXT PRIMARY KEY, closed INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)")
+            self._conn = conn
+            self._counts = None
+            self._pid = os.getpid()
+        return self._conn
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    # Run function(conn) in a write transaction; other processes wait for it to commit
+    def _write(self, function):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._counts = None
+            return result
+
+    @property
+    def rebuilt_at(self):
+        rows = self._query("SELECT value FROM meta WHERE key = 'rebuilt_at'")
+        return rows[0][0] if rows else 0
+
+    # The index is built once any process has rebuilt it
+    @property
+    def built(self):
+        return self.rebuilt_at > 0
+
+    # Replace the index; rooms is an iterable of (roomId, case_number), members(roomId) returns personIds
+    def rebuild(self, rooms, members):
+        rooms = [(room_id, case_number or None, list(members(room_id)) if case_number else [])
+                 for room_id, case_number in rooms]
+
+        def replace(conn):
+            conn.execute("DELETE FROM rooms")
+            conn.execute("DELETE FROM members")
+            for room_id, case_number, room_members in rooms:
+                conn.execute("INSERT OR REPLACE INTO rooms (room_id, case_number) VALUES (?, ?)",
+                             (room_id, case_number))
+                conn.executemany("INSERT OR IGNORE INTO members (room_id, person_id) VALUES (?, ?)",
+                                 [(room_id, person_id) for person_id in room_members])
+                if case_number:
+                    conn.execute("INSERT OR IGNORE INTO cases (case_number) VALUES (?)", (case_number,))
+            # Keep the open/closed state of cases that still have rooms
+            conn.execute("DELETE FROM cases WHERE case_number NOT IN (SELECT case_number FROM rooms "
+                         "WHERE case_number IS NOT NULL)")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', ?)", (time.time(),))
+        self._write(replace)
+
+    # Add a room; rooms without a case number are only counted
+    def add_room(self, room_id, case_number, members=()):
+        def add(conn):
+            conn.execute("INSERT OR REPLACE INTO rooms (room_id, case_number) VALUES (?, ?)",
+                         (room_id, case_number or None))
+            if case_number:
+                conn.execute("INSERT OR IGNORE INTO cases (case_number) VALUES (?)", (case_number,))
+                conn.executemany("INSERT OR IGNORE INTO members (room_id, person_id) VALUES (?, ?)",
+                                 [(room_id, person_id) for person_id in members])
+        self._write(add)
+
+    def remove_room(self, room_id):
+        def remove(conn):
+            conn.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+            conn.execute("DELETE FROM members WHERE room_id = ?", (room_id,))
+            conn.execute("DELETE FROM cases WHERE case_number NOT IN (SELECT case_number FROM rooms "
+                         "WHERE case_number IS NOT NULL)")
+        self._write(remove)
+
+    def has_room(self, room_id):
+        return bool(self._query("SELECT 1 FROM rooms WHERE room_id = ?", (room_id,)))
+
+    # Add a member to a room already in the index; returns False for unknown rooms.
+    # Members of rooms without a case number are not tracked.
+    def add_member(self, room_id, person_id):
+        def add(conn):
+            room = conn.execute("SELECT case_number FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+            if room is None:
+                return False
+            if room[0] is not None:
+                conn.execute("INSERT OR IGNORE INTO members (room_id, person_id) VALUES (?, ?)", (room_id, person_id))
+            return True
+        return self._write(add)
+
+    def remove_member(self, room_id, person_id):
+        self._write(lambda conn: conn.execute("DELETE FROM members WHERE room_id = ? AND person_id = ?",
+                                              (room_id, person_id)))
+
+    # Return the roomId of a room for case_number that person_id is a member of, or None
+    def find_room(self, case_number, person_id):
+        rows = self._query("SELECT rooms.room_id FROM rooms JOIN members ON members.room_id = rooms.room_id "
+                           "WHERE rooms.case_number = ? AND members.person_id = ? LIMIT 1", (case_number, person_id))
+        return rows[0][0] if rows else None
+
+    def rooms_for_case(self, case_number):
+        return [row[0] for row in self._query("SELECT room_id FROM rooms WHERE case_number = ?", (case_number,))]
+
+    # Record whether a case with rooms is closed; cases without rooms are ignored
+    def set_case_closed(self, case_number, closed):
+        # Checked first, as most lookups find the state unchanged
+        if self._query("SELECT 1 FROM cases WHERE case_number = ? AND closed IS ?", (case_number, int(closed))):
+            return
+        self._write(lambda conn: conn.execute("UPDATE cases SET closed = ? WHERE case_number = ?",
+                                              (int(closed), case_number)))
+
+    # Case numbers whose open/closed state is not known, or that were open when last seen
+    def cases_not_closed(self):
+        return [row[0] for row in self._query("SELECT case_number FROM cases WHERE closed IS NOT 1")]
+
+    # Room totals, by case rooms vs other rooms and open vs closed cases; kept until any process changes the index
+    def counts(self):
+        with self._lock:
+            version = self._connect().execute("PRAGMA data_version").fetchone()[0]
+            if self._counts is None or self._counts_version != version:
+                total, case_rooms, open_, closed = self._connect().execute(
+                    "SELECT COUNT(*), COUNT(rooms.case_number), COALESCE(SUM(cases.closed = 0), 0), "
+                    "COALESCE(SUM(cases.closed = 1), 0) FROM rooms "
+                    "LEFT JOIN cases ON cases.case_number = rooms.case_number").fetchone()
+                self._counts = {
+                    "total": total,
+                    "case_rooms": case_rooms,
+                    "other_rooms": total - case_rooms,
+                    "open_case_rooms": open_,
+                    "closed_case_rooms": closed,
+                    "unknown_case_rooms": case_rooms - open_ - closed
+                }
+                self._counts_version = version
+            return dict(self._counts)
+
+    # Number of case rooms
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM rooms WHERE case_number IS NOT NULL")[0][0]
+
+
+# Create the room index; in a SQLite file if a path is given, otherwise in memory
+def create_room_index(path=None):
+    if path:
+        return SqliteRoomIndex(path)
+    return RoomIndex()
@@ -0,0 +1,57 @@
+"""
+singleflight.py contains the request coalescing used by utilities.py for case lookups and token refreshes
+"""
+
+import threading
+from metrics import coalesced_calls
+
+
+# A call in flight, whose result or error is shared with the callers waiting for it
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Runs one call at a time per key: callers arriving while a call for their key is in flight wait for it,
+# and share its result or error instead of making their own call
+class SingleFlight(object):
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}    # key -> Call
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            coalesced_calls.inc(self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        return len(self._calls)
@@ -0,0 +1,90 @@
+"""
+startup.py contains the startup timing and readiness checks reported by bot.py on /ready
+"""
+
+import fcntl
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Records how long each startup phase took, and which readiness checks have passed
+class StartupState(object):
+    def __init__(self):
+        self.started = time.time()
+        self.phases = OrderedDict()     # phase -> seconds
+        self.checks = OrderedDict()     # check -> True (passed), False (failed) or None (pending)
+        self.errors = {}                # check -> last error
+        self._lock = threading.Lock()
+
+    # Time a phase; when `check` is set it passes if the phase completes without an error
+    @contextmanager
+    def phase(self, name, check=None):
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            if check:
+                self.set_check(check, False, e)
+            raise
+        finally:
+            with self._lock:
+                self.phases[name] = round(time.time() - started, 3)
+        if check:
+            self.set_check(check, True)
+
+    # Record the time since the process started as a phase, e.g. once the modules are imported
+    def mark(self, name):
+        with self._lock:
+            self.phases[name] = max(0.0, round(time.time() - self.started - sum(self.phases.values()), 3))
+
+    def add_check(self, name):
+        with self._lock:
+            self.checks.setdefault(name, None)
+
+    def set_check(self, name, passed, error=None):
+        with self._lock:
+            self.checks[name] = passed
+            if error is not None:
+                self.errors[name] = str(error)
+            else:
+                self.errors.pop(name, None)
+
+    def pending(self):
+        return [name for name, passed in self.checks.items() if not passed]
+
+    def ready(self):
+        return not self.pending()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "ready": all(self.checks.values()),
+                "checks": dict(self.checks),
+                "errors": dict(self.errors),
+                "startup_seconds": dict(self.phases)
+            }
+
+    # Log the startup timing breakdown
+    def log(self):
+        sys.stderr.write("Startup times: {}\n".format(", ".join("{} {:.3f}s".format(name, seconds)
+                                                                for name, seconds in self.phases.items())))
+
+
+startup = StartupState()
+
+
+# Take a lock shared by the processes forked from one server, without waiting.
+# Returns the open lock file, which holds the lock until it is closed, or None if another process holds it.
+def try_server_lock(name):
+    path = os.path.join(os.environ.get("BOT_LOCK_DIR", "/tmp"), "{}-{}.lock".format(name, os.getppid()))
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return None
+    return lock_file
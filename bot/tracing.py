@@ -0,0 +1,131 @@
+"""
+tracing.py contains the per-request traces used to find where the time of a slow command went
+"""
+
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Requests slower than this many seconds are logged and kept for /traces/slow
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", "2"))
+SLOW_TRACE_LIMIT = int(os.environ.get("SLOW_TRACE_LIMIT", "50"))
+
+_local = threading.local()
+_trace_ids = itertools.count(1)
+slow_traces = deque(maxlen=SLOW_TRACE_LIMIT)
+
+
+# The timed spans of one request.  Spans may be added from several threads.
+class Trace(object):
+    def __init__(self, name, **attributes):
+        self.id = next(_trace_ids)
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self.duration = None
+        self.spans = []     # (name, offset from start, duration, thread name)
+
+    def add_span(self, name, started, duration):
+        self.spans.append((name, started - self.started, duration, threading.current_thread().name))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "attributes": self.attributes,
+            "started": self.started,
+            "duration": self.duration,
+            "spans": [{"name": name, "offset": round(offset, 4), "duration": round(duration, 4), "thread": thread}
+                      for name, offset, duration, thread in sorted(self.spans, key=lambda s: s[1])]
+        }
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+# Start a trace for the request handled by this thread
+def start_trace(name, **attributes):
+    _local.trace = Trace(name, **attributes)
+    return _local.trace
+
+
+# Finish the trace of this thread; slow traces are logged and kept
+def finish_trace(threshold=None):
+    trace = current_trace()
+    _local.trace = None
+    if trace is None:
+        return None
+    trace.duration = time.time() - trace.started
+    if trace.duration >= (SLOW_REQUEST_THRESHOLD if threshold is None else threshold):
+        record = trace.to_dict()
+        slow_traces.append(record)
+        sys.stderr.write("Slow request: {}\n".format(json.dumps(record, sort_keys=True)))
+    return trace
+
+
+# Record a span that has already ended, e.g. from a requests response hook
+def record_span(name, duration):
+    trace = current_trace()
+    if trace is not None:
+        trace.add_span(name, time.time() - duration, duration)
+
+
+# Context manager timing a block as a span of the current trace; does nothing outside a trace
+class span(object):
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+
+    def __enter__(self):
+        self.trace = current_trace()
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.trace is not None:
+            self.trace.add_span(self.name, self.started, time.time() - self.started)
+
+
+# Decorator timing every call of a function as a span
+def traced(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return function(*args, **kwargs)
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                trace.add_span(name, started, time.time() - started)
+        return wrapper
+    return decorate
+
+
+# Wrap a function so it runs in the caller's trace, e.g. when it is handed to a thread pool
+def bind(function):
+    trace = current_trace()
+    if trace is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = current_trace()
+        _local.trace = trace
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return wrapper
+
+
+# Return the most recent slow traces, newest first
+def recent_slow_traces(limit=10):
+    return list(reversed(slow_traces))[:limit]
@@ -4,32 +4,74 @@
 utilities.py file contains supporting functions for bot.py
 """
 
-import re
 import requests
 import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from email.utils import parsedate_tz, mktime_tz
 from ciscosparkapi import CiscoSparkAPI
 from case import CaseDetail
+from message_parser import parse_message, case_number_regex, email_syntax_regex, cisco_email_regex
+from cache import TTLCache
+from case_store import create_case_store
+from room_index import create_room_index
+from ratelimit import TokenBucket
+from singleflight import SingleFlight
+from metrics import instrument_session, upstream_errors, case_lookups
+from tracing import traced, bind
 
+
+# Label Spark requests by method and resource, e.g. ("spark", "GET messages")
+def classify_spark_request(method, url):
+    path = url.split("?", 1)[0].split("/v1/", 1)[-1]
+    return "spark", "{} {}".format(method, path.split("/", 1)[0])
+
+
+# Spark REST API base URL; can be pointed at a local stand-in, e.g. by the load test harness
+SPARK_API_URL = os.environ.get("SPARK_API_URL", "https://api.ciscospark.com/v1/")
+
+
+# Create a Spark API client whose requests are recorded in the upstream metrics
+def create_spark_api(access_token):
+    api = CiscoSparkAPI(access_token=access_token, base_url=SPARK_API_URL)
+    # ciscosparkapi does not expose its requests session
+    instrument_session(api.session._req_session, classify_spark_request)
+    return api
+
+
+# The Spark client is created on first use, from SPARK_BOT_TOKEN or the token set through set_spark_token
 spark_token = os.environ.get("SPARK_BOT_TOKEN")
-spark = CiscoSparkAPI(access_token=spark_token)
+spark_client = None
+spark_client_lock = threading.Lock()
+
+
+# Return the Spark API client, or None if no token has been configured
+def get_spark():
+    global spark_client
+    if spark_client is None and spark_token is not None:
+        with spark_client_lock:
+            if spark_client is None:
+                spark_client = create_spark_api(spark_token)
+    return spark_client
+
+
+# Use a new Spark token; the client is recreated on next use
+def set_spark_token(token):
+    global spark_token, spark_client
+    with spark_client_lock:
+        spark_token = token
+        spark_client = None
 
 
 #
 # Supporting functions
 #
 
-# Return contents following a given command
-def extract_message(command, text):
-    cmd_loc = text.find(command)
-    message = text[cmd_loc + len(command):]
-    return message
-
-
 # Check if user is cisco.com email address
 def check_cisco_user(content):
-    pattern = re.compile("^([a-zA-Z0-9_\-\.]+)@(cisco)\.(com)$")
-
-    if pattern.match(content):
+    if cisco_email_regex.match(content):
         return True
     else:
         return False
@@ -37,9 +79,7 @@ def check_cisco_user(content):
 
 # Check if email is syntactically correct
 def check_email_syntax(content):
-    pattern = re.compile("^([a-zA-Z0-9_\-\.]+)@([a-zA-Z0-9_\-\.]+)\.([a-zA-Z]{2,5})$")
-
-    if pattern.match(content):
+    if email_syntax_regex.match(content):
         return True
     else:
         return False
@@ -48,8 +88,7 @@ def check_email_syntax(content):
 # Match case number in string
 def verify_case_number(content):
     # Check if there is a case number in the incoming message content
-    pattern = re.compile("(6[0-9]{8})")
-    match = pattern.search(content)
+    match = case_number_regex.search(content)
 
     if match:
         case_number = match.group(0)
@@ -58,52 +97,346 @@ def verify_case_number(content):
         return False
 
 
-# Check for case number in message content, if none check in room name
-def get_case_number(content, room_id):
-    case_number = verify_case_number(content)
-    if case_number:
-        return case_number
+# Match all case numbers in string, in order and without duplicates
+def verify_case_numbers(content):
+    return parse_message(content).case_numbers
+
+
+# The case number in the room name, as a list
+def get_room_case_numbers(room_id):
+    room_case_number = get_room_info(room_id)[1]
+    if room_case_number:
+        return [room_case_number]
     else:
-        room_name = get_room_name(room_id)
-        case_number = verify_case_number(room_name)
-        if case_number:
-            return case_number
-        else:
-            return False
+        return []
+
+#
+# HTTP client functions
+#
+
+SSO_URL = os.environ.get("SSO_URL", "https://cloudsso.cisco.com")
+CASE_API_URL = os.environ.get("CASE_API_URL", "https://api.cisco.com")
+
+# Connection pool size for each host; connections are kept alive and reused between commands
+HTTP_POOL_SIZES = {
+    SSO_URL: int(os.environ.get("SSO_POOL_SIZE", "2")),
+    CASE_API_URL: int(os.environ.get("CASE_API_POOL_SIZE", "10"))
+}
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "15"))
+
+# Retry 429 and 5xx responses with exponential backoff, or as long as Retry-After asks (up to a limit)
+HTTP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", "0.5"))
+HTTP_MAX_RETRY_DELAY = float(os.environ.get("HTTP_MAX_RETRY_DELAY", "30"))
+
+
+# Label Case API and SSO requests for the upstream metrics
+def classify_http_request(method, url):
+    if url.startswith(SSO_URL):
+        return "sso", "token"
+    if url.startswith(CASE_API_URL):
+        return "case_api", "case_details"
+    return "other", url.split("/")[2] if "//" in url else url
+
+
+# Create the shared HTTP session used for all Case API and SSO traffic
+def create_http_session():
+    session = requests.Session()
+    for url, pool_size in HTTP_POOL_SIZES.items():
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount(url + "/", adapter)
+    return instrument_session(session, classify_http_request)
+
+
+http_session = create_http_session()
+
+
+# Open new Spark and HTTP connections, e.g. in a server process forked after this module was imported
+def reset_connections():
+    global spark_client, spark_client_lock, http_session
+    spark_client = None
+    spark_client_lock = threading.Lock()
+    http_session = create_http_session()
+
+
+# Return the number of seconds a response asks us to wait, or None
+def get_retry_after(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        # Retry-After can also be an HTTP date
+        retry_date = parsedate_tz(retry_after)
+        if retry_date is None:
+            return None
+        return max(0.0, mktime_tz(retry_date) - time.time())
+
+
+# Send an HTTP request over the shared session, retrying 429 and 5xx responses
+def http_request(method, url, **kwargs):
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    attempt = 0
+    while True:
+        try:
+            response = http_session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            # Timeouts and connection errors never reach the response hook
+            upstream_errors.inc(*classify_http_request(method, url))
+            raise
+        if response.status_code not in HTTP_RETRY_STATUS_CODES or attempt >= HTTP_MAX_RETRIES:
+            return response
+
+        delay = get_retry_after(response)
+        if delay is None:
+            delay = HTTP_BACKOFF_FACTOR * (2 ** attempt)
+        delay = min(delay, HTTP_MAX_RETRY_DELAY)
+        sys.stderr.write("{} {} returned {}, retrying in {:.1f}s\n".format(method, url, response.status_code, delay))
+
+        # Release the connection back to the pool before sleeping
+        response.close()
+        attempt += 1
+        time.sleep(delay)
+
 
 #
 # Case API functions
 #
 
-# Get access-token for Case API
-def get_access_token():
+# Refresh the Case API access-token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = int(os.environ.get("CASE_API_TOKEN_REFRESH_MARGIN", "60"))
+
+
+# Keeps the Case API access-token in memory until shortly before it expires
+class AccessTokenManager(object):
+    def __init__(self, fetch, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._fetch = fetch
+        self._refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._refreshes = SingleFlight("access_token")
+
+    def _is_valid(self):
+        return self._token is not None and time.time() < self._expires_at - self._refresh_margin
+
+    def get_token(self):
+        if self._is_valid():
+            return self._token
+
+        # Only one caller refreshes the token, the others wait for it and share the new token or the error
+        return self._refreshes.do("token", self._refresh)
+
+    def _refresh(self):
+        if not self._is_valid():
+            token_data = self._fetch()
+            with self._lock:
+                self._token = token_data['access_token']
+                self._expires_at = time.time() + int(token_data.get('expires_in', 0))
+        return self._token
+
+    # Drop the cached token, unless it has already been replaced by a newer one
+    def invalidate(self, token=None):
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0
+
+
+# Request a new access-token for Case API from cloudsso
+def request_access_token():
     client_id = os.environ.get("CASE_API_CLIENT_ID")
     client_secret = os.environ.get("CASE_API_CLIENT_SECRET")
     grant_type = "client_credentials"
-    url = "https://cloudsso.cisco.com/as/token.oauth2"
+    url = SSO_URL + "/as/token.oauth2"
     payload = "client_id="+client_id+"&grant_type=client_credentials&client_secret="+client_secret
     headers = {
         'accept': "application/json",
         'content-type': "application/x-www-form-urlencoded",
         'cache-control': "no-cache"
     }
-    response = requests.request("POST", url, data=payload, headers=headers)
+    response = http_request("POST", url, data=payload, headers=headers)
     if (response.status_code == 200):
-        return response.json()['access_token']
+        return response.json()
     else:
         response.raise_for_status()
 
 
-# Get case details from CASE API
-def get_case_details(case_number):
-    access_token = get_access_token()
+token_manager = AccessTokenManager(request_access_token)
+
 
-    url = "https://api.cisco.com/case/v3/cases/details/case_id/" + str(case_number)
+# Get access-token for Case API
+@traced("get_access_token")
+def get_access_token():
+    return token_manager.get_token()
+
+
+# Send the case details request to CASE API
+def request_case_details(case_number, access_token):
+    url = CASE_API_URL + "/case/v3/cases/details/case_id/" + str(case_number)
     headers = {
         'authorization': "Bearer " + access_token,
         'cache-control': "no-cache"
     }
-    response = requests.request("GET", url, headers=headers)
+    return http_request("GET", url, headers=headers)
+
+
+# Case details are shared across commands, rooms and users.  For CASE_CACHE_TTL seconds they are fresh and
+# served from memory.  For CASE_CACHE_STALE_TTL seconds after that they are stale: still served from memory,
+# while they are refetched in the background.  Older details have expired and are refetched before replying.
+CASE_CACHE_TTL = int(os.environ.get("CASE_CACHE_TTL", "300"))
+CASE_CACHE_STALE_TTL = int(os.environ.get("CASE_CACHE_STALE_TTL", "900"))
+CASE_CACHE_MAX_ENTRIES = int(os.environ.get("CASE_CACHE_MAX_ENTRIES", "1000"))
+CASE_CACHE_MAX_BYTES = int(os.environ.get("CASE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+case_cache = TTLCache(CASE_CACHE_TTL + CASE_CACHE_STALE_TTL, CASE_CACHE_MAX_ENTRIES, CASE_CACHE_MAX_BYTES,
+                      sizeof=sys.getsizeof)
+
+
+# Mark cached case details as stale so the next lookup refetches them
+def invalidate_case(case_number):
+    if case_store is not None:
+        case_store.invalidate("cases", str(case_number))
+    return case_cache.invalidate(str(case_number))
+
+
+# Get case details kept in the case store, e.g. by the process before a restart, or None
+def load_stored_case(case_number):
+    if case_store is None:
+        return None
+    row = case_store.get("cases", case_number)
+    if row is None:
+        return None
+    # Keep the time the case was fetched, so it goes stale as if the process had not restarted
+    case = CaseDetail(row[0], fetched_at=row[1])
+    case_cache.set(case_number, case, stored_at=row[1])
+    record_case_state(case_number, case)
+    return case
+
+
+# True if cached case details are older than CASE_CACHE_TTL
+def case_is_stale(case):
+    return time.time() - case.fetched_at >= CASE_CACHE_TTL
+
+
+# Get case details as a CaseDetail, from the cache if available.
+# Stale details are returned right away and refreshed in the background.
+@traced("get_case_details")
+def get_case_details(case_number):
+    case = case_cache.get(str(case_number)) or load_stored_case(str(case_number))
+    if case is None:
+        case_lookups.inc("expired")
+        return fetch_and_cache_case(case_number)
+    if case_is_stale(case):
+        case_lookups.inc("stale")
+        refresh_case_in_background(str(case_number))
+    else:
+        case_lookups.inc("fresh")
+    return case
+
+
+# Case fetches in flight, by case number
+case_fetches = SingleFlight("case_details")
+
+
+# Fetch case details from CASE API, and cache them.
+# Concurrent fetches of the same case share a single request, and its result or error.
+def fetch_and_cache_case(case_number):
+    return case_fetches.do(str(case_number), fetch_and_cache_case_once, case_number)
+
+
+def fetch_and_cache_case_once(case_number):
+    case = CaseDetail(fetch_case_details(case_number))
+    # Don't cache API errors (e.g. case not found), so they are retried on the next command
+    if not case.error:
+        case_cache.set(str(case_number), case)
+        if case_store is not None:
+            case_store.put("cases", str(case_number), case.to_json())
+        record_case_state(case_number, case)
+    return case
+
+
+# Number of stale cases refetched in the background at once
+CASE_REFRESH_CONCURRENCY = int(os.environ.get("CASE_REFRESH_CONCURRENCY", "2"))
+
+case_refresh_pool = None
+cases_refreshing = set()
+cases_refreshing_lock = threading.Lock()
+
+
+# Refetch stale case details in the background, unless they are already being refetched
+def refresh_case_in_background(case_number):
+    global case_refresh_pool
+    with cases_refreshing_lock:
+        if case_number in cases_refreshing:
+            return
+        cases_refreshing.add(case_number)
+        if case_refresh_pool is None:
+            case_refresh_pool = ThreadPool(CASE_REFRESH_CONCURRENCY)
+    case_refresh_pool.apply_async(refresh_stale_case, (case_number,))
+
+
+# On failure the stale details are kept, and served until they expire
+def refresh_stale_case(case_number):
+    try:
+        fetch_and_cache_case(case_number)
+    except Exception as e:
+        sys.stderr.write("Unable to refresh details for SR {}: {}\n".format(case_number, e))
+    finally:
+        with cases_refreshing_lock:
+            cases_refreshing.discard(case_number)
+
+
+# Fetch case details from CASE API, bypassing and then updating the cache.
+# If the fetch fails, the cached details are kept and served until they expire.
+def refresh_case_details(case_number):
+    return fetch_and_cache_case(case_number)
+
+
+# Number of case details fetched in parallel when a command names several cases
+CASE_FETCH_CONCURRENCY = int(os.environ.get("CASE_FETCH_CONCURRENCY", "8"))
+
+case_fetch_pool = None
+case_fetch_pool_lock = threading.Lock()
+
+
+# Get the thread pool for concurrent case lookups, created on first use in each process
+def get_case_fetch_pool():
+    global case_fetch_pool
+    with case_fetch_pool_lock:
+        if case_fetch_pool is None:
+            case_fetch_pool = ThreadPool(CASE_FETCH_CONCURRENCY)
+        return case_fetch_pool
+
+
+# Get case details, or None if the lookup failed
+def try_get_case_details(case_number):
+    try:
+        return get_case_details(case_number)
+    except Exception as e:
+        sys.stderr.write("Unable to get details for SR {}: {}\n".format(case_number, e))
+        return None
+
+
+# Get case details for several case numbers concurrently, in the same order; None for failed lookups
+def get_many_case_details(case_numbers):
+    if len(case_numbers) == 1:
+        return [try_get_case_details(case_numbers[0])]
+    return get_case_fetch_pool().map(bind(try_get_case_details), case_numbers)
+
+
+# Get case details from CASE API
+def fetch_case_details(case_number):
+    access_token = get_access_token()
+    response = request_case_details(case_number, access_token)
+
+    # The cached token may have been revoked before it expired; refresh it and retry once
+    if (response.status_code == 401):
+        token_manager.invalidate(access_token)
+        response = request_case_details(case_number, get_access_token())
 
     if (response.status_code == 200):
         # Uncomment to debug
@@ -118,82 +451,264 @@ def get_case_details(case_number):
 # Spark functions
 #
 
-# Get all rooms name matching case number
-def get_matching_rooms(case_number):
-    rooms = spark.rooms.list()
-    matches = [x for x in rooms if str(case_number) in x.title]
-    return matches
+# Room titles rarely change, so the title and the case number parsed from it are cached by roomId.
+# Entries are refreshed when Spark sends a rooms/updated webhook.
+ROOM_CACHE_TTL = int(os.environ.get("ROOM_CACHE_TTL", "86400"))
+ROOM_CACHE_MAX_ENTRIES = int(os.environ.get("ROOM_CACHE_MAX_ENTRIES", "5000"))
+
+room_cache = TTLCache(ROOM_CACHE_TTL, ROOM_CACHE_MAX_ENTRIES)   # roomId -> (title, case_number)
+
+
+# Set CASE_STORE_PATH to keep case details and room titles in a SQLite file, so the caches start warm after a
+# restart.  Rows are kept for the TTL of the matching cache.  Server processes sharing the file drop the cases
+# and rooms invalidated by the others within a couple of CASE_STORE_FLUSH_INTERVALs.
+case_store = create_case_store({"cases": CASE_CACHE_TTL + CASE_CACHE_STALE_TTL, "rooms": ROOM_CACHE_TTL})
+
+
+# Add a room title to the room cache
+def remember_room(room_id, title, stored_at=None):
+    room_info = (title, verify_case_number(title))
+    room_cache.set(room_id, room_info, stored_at=stored_at)
+    if case_store is not None and stored_at is None:
+        case_store.put("rooms", room_id, title)
+    return room_info
+
+
+# Drop a room from the room cache
+def forget_room(room_id):
+    if case_store is not None:
+        case_store.invalidate("rooms", room_id)
+    return room_cache.invalidate(room_id)
+
+
+# Drop a case or room invalidated by another server process, e.g. on /refresh or a rooms/updated webhook
+def drop_invalidated(table, key):
+    if table == "cases":
+        case_cache.invalidate(key)
+    elif table == "rooms":
+        room_cache.invalidate(key)
+
+
+if case_store is not None:
+    case_store.on_invalidate(drop_invalidated)
+
+
+# Get the room title kept in the case store as (title, case_number), or None
+def load_stored_room(room_id):
+    if case_store is None:
+        return None
+    row = case_store.get("rooms", room_id)
+    if row is None:
+        return None
+    return remember_room(room_id, row[0], stored_at=row[1])
 
 
-# Get Spark room name using CiscoSparkAPI
-def get_room_name(room_id):
-    room_name = spark.rooms.get(room_id).title
-    return room_name
+# Get (title, case_number) for a room, case_number is False if the title has none
+@traced("get_room_info")
+def get_room_info(room_id):
+    room_info = room_cache.get(room_id) or load_stored_room(room_id)
+    if room_info is None:
+        room_info = remember_room(room_id, get_spark().rooms.get(room_id).title)
+    return room_info
 
 
 # Create Spark Room
 def create_room(case_number):
-    case = CaseDetail(get_case_details(case_number))
+    case = get_case_details(case_number)
     title = case.title
     if title:
         data = "SR {}: {}".format(case_number, title)
     else:
         data = "SR {}".format(case_number)
 
-    new_room = spark.rooms.create(data)
+    new_room = get_spark().rooms.create(data)
+    remember_room(new_room.id, new_room.title)
+    room_index.add_room(new_room.id, case_number)
     return new_room.id
 
 
 # Get room membership
 def get_membership(room_id):
-    memberships= spark.memberships.list(roomId=room_id)
+    memberships= get_spark().memberships.list(roomId=room_id)
     return memberships
 
 
+# Person directory, both ways, and the cisco.com authorization decision for each person
+PERSON_CACHE_TTL = int(os.environ.get("PERSON_CACHE_TTL", "3600"))
+PERSON_CACHE_MAX_ENTRIES = int(os.environ.get("PERSON_CACHE_MAX_ENTRIES", "5000"))
+
+person_emails = TTLCache(PERSON_CACHE_TTL, PERSON_CACHE_MAX_ENTRIES)        # personId -> email
+person_ids = TTLCache(PERSON_CACHE_TTL, PERSON_CACHE_MAX_ENTRIES)           # email -> personId
+person_authorized = TTLCache(PERSON_CACHE_TTL, PERSON_CACHE_MAX_ENTRIES)    # personId -> bool
+
+
+# Add a known personId and email pair to the person directory
+def remember_person(person_id, email):
+    if person_id and email:
+        person_emails.set(person_id, email)
+        person_ids.set(email.lower(), person_id)
+
+
 # Get person_id for email address
 def get_person_id(email):
     if check_email_syntax(email):
-        person = spark.people.list(email=email)
+        person_id = person_ids.get(email.lower())
+        if person_id is not None:
+            return person_id
+
+        person = get_spark().people.list(email=email)
 
         # Future capabilities of Spark allow for multiple emails.
         # Today, iterating through GeneratorContainer created by CiscoSparkAPI will yield only one personId.
         # This may break in the future if GeneratorContainer returns multiple items
+        person_id = None
         for p in person:
             person_id = p.id
+        remember_person(person_id, email)
         return person_id
     else:
         return False
 
 
 # Get email address for provided personId
+@traced("get_email")
 def get_email(person_id):
+    email = person_emails.get(person_id)
+    if email is not None:
+        return email
+
     # Future capabilities of Spark allow for multiple emails.
     # Today, iterating through GeneratorContainer created by CiscoSparkAPI will yield only one personId.
     # This may break in the future if GeneratorContainer returns multiple items
-    email = spark.people.get(person_id).emails[0]
+    email = get_spark().people.get(person_id).emails[0]
+    remember_person(person_id, email)
     return email
 
 
+# Check if personId belongs to a cisco.com user
+@traced("check_cisco_person")
+def check_cisco_person(person_id):
+    authorized = person_authorized.get(person_id)
+    if authorized is None:
+        authorized = check_cisco_user(get_email(person_id))
+        person_authorized.set(person_id, authorized)
+    return authorized
+
+
 # Create membership
 def create_membership(person_id, new_room_id):
-    new_membership = spark.memberships.create(new_room_id, personId=person_id)
+    new_membership = get_spark().memberships.create(new_room_id, personId=person_id)
+    room_index.add_member(new_room_id, person_id)
     return new_membership.id
 
 
+# Local index of case number -> rooms -> members, kept current from room and membership changes.
+# Set ROOM_INDEX_PATH to keep it in a SQLite file, shared between processes and across restarts.
+room_index = create_room_index(os.environ.get("ROOM_INDEX_PATH"))
+
+
+# Rebuild the room index from every room the bot is a member of
+def rebuild_room_index():
+    rooms = []
+    for r in get_spark().rooms.list():
+        rooms.append((r.id, remember_room(r.id, r.title)[1]))
+    room_index.rebuild(rooms, lambda room_id: [m.personId for m in get_membership(room_id)])
+    return len(room_index)
+
+
+# Keep the open/closed state of a case in the room index, for the room counts
+def record_case_state(case_number, case):
+    if not case.error:
+        room_index.set_case_closed(str(case_number), "Closed" in (case.status or ""))
+
+
+# Update the room index from a memberships webhook
+def update_room_index(event, room_id, person_id, bot_left=False):
+    if event == "deleted" and bot_left:
+        forget_room(room_id)
+
+    # Until the index is first built, the rebuild picks up every change
+    if not room_index.built:
+        return
+
+    if event == "deleted":
+        if bot_left:
+            room_index.remove_room(room_id)
+        else:
+            room_index.remove_member(room_id, person_id)
+    elif event == "created":
+        if not room_index.add_member(room_id, person_id):
+            # First time the room is seen, e.g. the bot was just added to it
+            case_number = get_room_info(room_id)[1]
+            if case_number:
+                room_index.add_room(room_id, case_number, [m.personId for m in get_membership(room_id)])
+            else:
+                room_index.add_room(room_id, False)
+
+
+# The room index is recounted from Spark every ROOM_RECOUNT_INTERVAL seconds, in case a webhook was missed.
+# Case states are then refreshed at up to ROOM_RECOUNT_CASE_RATE Case API lookups per second.
+ROOM_RECOUNT_INTERVAL = int(os.environ.get("ROOM_RECOUNT_INTERVAL", "21600"))
+ROOM_RECOUNT_CASE_RATE = float(os.environ.get("ROOM_RECOUNT_CASE_RATE", "1"))
+
+room_recount_thread = None
+room_recount_lock = threading.Lock()
+
+
+# Rebuild the room index, then look up the state of every case not known to be closed
+def recount_rooms():
+    rebuild_room_index()
+    rate_limit = TokenBucket(ROOM_RECOUNT_CASE_RATE)
+    for case_number in room_index.cases_not_closed():
+        rate_limit.acquire()
+        case = try_get_case_details(case_number)
+        if case is not None:
+            record_case_state(case_number, case)
+
+
+def room_recount_loop():
+    while True:
+        # Processes sharing ROOM_INDEX_PATH see each other's recounts through rebuilt_at
+        wait = room_index.rebuilt_at + ROOM_RECOUNT_INTERVAL - time.time()
+        if wait > 0:
+            time.sleep(min(wait, 300))
+            continue
+        try:
+            recount_rooms()
+        except Exception as e:
+            sys.stderr.write("Room recount failed: {}\n".format(e))
+            time.sleep(300)
+
+
+# Start the periodic room recount, once in each process
+def start_room_recount():
+    global room_recount_thread
+    with room_recount_lock:
+        if room_recount_thread is None:
+            room_recount_thread = threading.Thread(target=room_recount_loop, name="room-recount")
+            room_recount_thread.daemon = True
+            room_recount_thread.start()
+
+
+# Room counts, from the room index, or None while the index is first built by the recount thread
+def get_room_counts():
+    start_room_recount()
+    if not room_index.built:
+        return None
+    return room_index.counts()
+
+
 # Check if room already exists for case and  user
 def room_exists_for_user(case_number, email):
     person_id = get_person_id(email)
-    rooms = get_matching_rooms(case_number)
-    for r in rooms:
-        room_memberships = get_membership(r.id)
-        for m in room_memberships:
-            if m.personId == person_id:
-                return r.id
-            else:
-                continue
+    if not room_index.built:
+        rebuild_room_index()
+    return room_index.find_room(case_number, person_id)
 
 
 # Invite user to room
 def invite_user(room_id, email):
-    new_membership = spark.memberships.create(room_id, personEmail=email)
+    new_membership = get_spark().memberships.create(room_id, personEmail=email)
+    if new_membership:
+        room_index.add_member(room_id, new_membership.personId)
     return new_membership
\ No newline at end of file
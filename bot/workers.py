@@ -0,0 +1,106 @@
+"""
+workers.py contains the worker pool used by bot.py to process webhooks in the background
+"""
+
+import sys
+import threading
+import time
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+# Bounded queue served by a pool of worker threads
+class WorkerPool(object):
+    def __init__(self, handler, num_workers, max_depth, name="worker"):
+        self._handler = handler
+        self.num_workers = num_workers
+        self.max_depth = max_depth
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._stopping = threading.Event()
+
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.high_water = 0
+
+    # Threads are started on first use, so each forked server process gets its own
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._run, name="{}-{}".format(self.name, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    # Queue an item without blocking; returns False if the queue is full or shutting down
+    def submit(self, item):
+        if not self._accepting:
+            self.rejected += 1
+            return False
+        self.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        self.high_water = max(self.high_water, self._queue.qsize())
+        return True
+
+    # Workers poll the queue, so shutdown can stop them without having to put anything on a full queue
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                self._handler(item)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                sys.stderr.write("{} failed to process item:\n{}".format(self.name, traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+    # Stop accepting new items, let the workers drain the queue and wait for them to exit
+    def shutdown(self, timeout=None):
+        self._accepting = False
+        with self._lock:
+            threads = list(self._threads)
+            self._threads = []
+        if not threads:
+            return
+        sys.stderr.write("Draining {} queued {} items.\n".format(self._queue.qsize(), self.name))
+        # The workers exit once the queue is empty; the timeout covers the whole drain, not each thread
+        self._stopping.set()
+        deadline = time.time() + timeout if timeout is not None else None
+        for t in threads:
+            t.join(max(0, deadline - time.time()) if deadline is not None else None)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "workers": self.num_workers,
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "high_water": self.high_water,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed
+        }
@@ -0,0 +1,11 @@
+"""
+wsgi.py is the production entry point for the bot.  Run it with gunicorn, using the provided config:
+
+    gunicorn -c bot/gunicorn_conf.py wsgi:application
+
+The number of worker processes and threads per worker are read from BOT_WORKERS and BOT_THREADS.
+"""
+
+from bot import create_app
+
+application = create_app()
@@ -0,0 +1,80 @@
+#! /usr/bin/python
+"""
+    Microbenchmark for the message parser.
+
+    Times parse_message against the per-call regex functions it replaced, on a short command and on
+    pasted log dumps of increasing size, and prints the cost per message.
+
+    python loadtest/bench_parser.py
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bot"))
+from message_parser import parse_message
+
+COMMANDS = ["/title", "/device", "/owner", "/contract", "/customer", "/status", "/rma", "/bug", "/created",
+            "/updated", "/link", "/watch", "/unwatch", "/invite", "/feedback", "/help"]
+
+LOG_LINES = [
+    "Mar  1 10:15:{:02d}.{:03d} UTC: %LINK-3-UPDOWN: Interface GigabitEthernet0/{}, changed state to down",
+    "Mar  1 10:15:{:02d}.{:03d} UTC: %SYS-2-MALLOCFAIL: Memory allocation of {} bytes failed from 0x7F3A6C00",
+    "Mar  1 10:15:{:02d}.{:03d} UTC: %SEC_LOGIN-5-LOGIN_SUCCESS: Login Success [user: admin{}@example.com]",
+    "Mar  1 10:15:{:02d}.{:03d} UTC: %PLATFORM-4-ELEMENT_WARNING: R0/0: smand: 1/{}: file /bootflash/core 61234567890",
+]
+
+
+# A pasted log dump of about `size` characters, with a command and two case numbers up front
+def log_dump(size):
+    lines = ["/status 612345678 698765432 see log below:"]
+    length = len(lines[0])
+    while length < size:
+        line = random.choice(LOG_LINES).format(random.randrange(60), random.randrange(1000), random.randrange(10000))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+# The parsing done for each message before the single-pass parser: a regex compiled on every call,
+# and a separate scan of the text for the command, the case numbers and the email check
+def previous_parse(text):
+    match = re.compile(r"(?:^|\s)(/[\w-]+)").search(text)
+    command = match.group(1) if match and match.group(1) in COMMANDS else ""
+    argument = text[text.find(command) + len(command):].strip() if command else text.strip()
+    case_numbers = []
+    for case_number in re.compile("(6[0-9]{8})").findall(argument):
+        if case_number not in case_numbers:
+            case_numbers.append(case_number)
+    re.compile("^([a-zA-Z0-9_\-\.]+)@([a-zA-Z0-9_\-\.]+)\.([a-zA-Z]{2,5})$").match(argument)
+    return command, argument, case_numbers
+
+
+def bench(function, text):
+    runs = max(3, int(200000 / (len(text) + 100)))
+    seconds = min(timeit.repeat(lambda: function(text), number=runs, repeat=3)) / runs
+    return seconds * 1e6
+
+
+def main():
+    random.seed(1)
+    messages = [("short command", "/status 612345678")]
+    for size in (1000, 10000, 100000, 1000000):
+        messages.append(("log dump {}k".format(size // 1000), log_dump(size)))
+
+    commands = frozenset(COMMANDS)
+    print("{:<16} {:>10} {:>14} {:>14} {:>16}".format("message", "chars", "previous us", "parser us",
+                                                       "with emails us"))
+    for name, text in messages:
+        print("{:<16} {:>10} {:>14.1f} {:>14.1f} {:>16.1f}".format(
+            name, len(text), bench(previous_parse, text), bench(lambda t: parse_message(t, commands), text),
+            bench(lambda t: parse_message(t, commands).emails, text)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+fakes.py contains local stand-ins for the Spark REST API, the Case API and cloudsso, used by the load test
+"""
+
+import itertools
+import json
+import random
+import threading
+import time
+from flask import Flask, request
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+
+# JSON response; flask.jsonify is avoided because it depends on the installed Werkzeug version
+def jsonify(data):
+    return json.dumps(data), 200, {"Content-Type": "application/json"}
+
+
+# JSON error response, in the format of the Spark API
+def error(status, message, headers=None):
+    return json.dumps({"message": message}), status, dict(headers or {}, **{"Content-Type": "application/json"})
+
+
+# Keep the fake servers out of the bot's log
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Latency and error injection for a fake server
+class Faults(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1):
+        self.latency = latency          # seconds added to every request
+        self.jitter = jitter            # up to this many seconds more, at random
+        self.error_rate = error_rate    # fraction of requests answered with a 500
+        self.throttle_rate = throttle_rate  # fraction of throttled requests answered with a 429
+        self.retry_after = retry_after  # Retry-After of the 429s
+
+    def apply(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return error(500, "Injected error")
+        return None
+
+    # Answer a request with a 429, as Spark does when the bot sends too many messages
+    def throttle(self):
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            return error(429, "Too Many Requests", {"Retry-After": str(self.retry_after)})
+        return None
+
+
+# Serves a Flask app from a background thread on a free local port
+class FakeServer(object):
+    def __init__(self, app):
+        self.app = app
+        self._server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.url = "http://127.0.0.1:{}".format(self._server.server_port)
+        self.requests = 0
+        self._thread = threading.Thread(target=self._server.serve_forever, name=app.name)
+        self._thread.daemon = True
+
+        @app.before_request
+        def count_request():
+            self.requests += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+
+# In-memory Spark REST API: messages, people, rooms, memberships and webhooks
+class FakeSpark(FakeServer):
+    def __init__(self, faults, bot_email="tacbot@sparkbot.io"):
+        super(FakeSpark, self).__init__(Flask("fake-spark"))
+        self.faults = faults
+        self.bot = {"id": "person-bot", "emails": [bot_email], "displayName": "TAC Bot"}
+        self.people = {"person-bot": self.bot}
+        self.rooms = {}
+        self.memberships = []
+        self.messages = {}
+        self.webhooks = {}
+        self.reply_listeners = {}       # roomId -> function(message), called for messages posted by the bot
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._routes()
+
+    def new_id(self, kind):
+        return "{}-{}".format(kind, next(self._ids))
+
+    #
+    # Test setup, called directly by the load generator
+    #
+
+    def add_person(self, email):
+        person = {"id": "person-" + email.split("@")[0], "emails": [email], "displayName": email.split("@")[0]}
+        self.people[person["id"]] = person
+        return person
+
+    def add_room(self, title, members=()):
+        room = {"id": self.new_id("room"), "title": title, "type": "group", "isLocked": False}
+        self.rooms[room["id"]] = room
+        for person in list(members) + [self.bot]:
+            self.add_membership(room["id"], person)
+        return room
+
+    def add_membership(self, room_id, person):
+        membership = {"id": self.new_id("membership"), "roomId": room_id, "personId": person["id"],
+                      "personEmail": person["emails"][0], "isModerator": False, "isMonitor": False}
+        with self._lock:
+            self.memberships.append(membership)
+        return membership
+
+    def add_message(self, room_id, person, text):
+        message = {"id": self.new_id("message"), "roomId": room_id, "roomType": "group", "text": text,
+                   "personId": person["id"], "personEmail": person["emails"][0],
+                   "created": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())}
+        self.messages[message["id"]] = message
+        return message
+
+    #
+    # REST API
+    #
+
+    def _routes(self):
+        app = self.app
+
+        @app.before_request
+        def inject_faults():
+            return self.faults.apply()
+
+        @app.route("/v1/people/me")
+        def people_me():
+            return jsonify(self.bot)
+
+        @app.route("/v1/people/<person_id>")
+        def people_get(person_id):
+            if person_id not in self.people:
+                return error(404, "Person not found")
+            return jsonify(self.people[person_id])
+
+        @app.route("/v1/people")
+        def people_list():
+            email = request.args.get("email")
+            return jsonify({"items": [p for p in self.people.values() if email in p["emails"]]})
+
+        @app.route("/v1/rooms", methods=["GET", "POST"])
+        def rooms():
+            if request.method == "POST":
+                return jsonify(self.add_room(request.get_json(force=True)["title"]))
+            return jsonify({"items": list(self.rooms.values())})
+
+        @app.route("/v1/rooms/<room_id>")
+        def rooms_get(room_id):
+            if room_id not in self.rooms:
+                return error(404, "Room not found")
+            return jsonify(self.rooms[room_id])
+
+        @app.route("/v1/memberships", methods=["GET", "POST"])
+        def memberships():
+            if request.method == "POST":
+                data = request.get_json(force=True)
+                if "personId" in data:
+                    person = self.people[data["personId"]]
+                else:
+                    person = self.add_person(data["personEmail"])
+                return jsonify(self.add_membership(data["roomId"], person))
+            room_id = request.args.get("roomId")
+            with self._lock:
+                items = [m for m in self.memberships if room_id is None or m["roomId"] == room_id]
+            return jsonify({"items": items})
+
+        @app.route("/v1/messages", methods=["POST"])
+        def messages_create():
+            throttled = self.faults.throttle()
+            if throttled is not None:
+                return throttled
+            data = request.get_json(force=True)
+            message = {"id": self.new_id("message"), "roomId": data.get("roomId"), "text": data.get("markdown"),
+                       "markdown": data.get("markdown"), "personId": self.bot["id"],
+                       "personEmail": self.bot["emails"][0]}
+            listener = self.reply_listeners.get(message["roomId"])
+            if listener is not None:
+                listener(message)
+            return jsonify(message)
+
+        @app.route("/v1/messages/<message_id>")
+        def messages_get(message_id):
+            if message_id not in self.messages:
+                return error(404, "Message not found")
+            return jsonify(self.messages[message_id])
+
+        @app.route("/v1/webhooks", methods=["GET", "POST"])
+        def webhooks():
+            if request.method == "POST":
+                webhook = dict(request.get_json(force=True), id=self.new_id("webhook"))
+                self.webhooks[webhook["id"]] = webhook
+                return jsonify(webhook)
+            return jsonify({"items": list(self.webhooks.values())})
+
+        @app.route("/v1/webhooks/<webhook_id>", methods=["PUT"])
+        def webhooks_update(webhook_id):
+            self.webhooks[webhook_id].update(request.get_json(force=True))
+            return jsonify(self.webhooks[webhook_id])
+
+
+# Case API v3 case details, for any case number starting with 6
+class FakeCaseAPI(FakeServer):
+    def __init__(self, faults):
+        super(FakeCaseAPI, self).__init__(Flask("fake-case-api"))
+        self.faults = faults
+
+        @self.app.route("/case/v3/cases/details/case_id/<case_number>")
+        def case_details(case_number):
+            if not request.headers.get("Authorization", "").startswith("Bearer "):
+                return error(401, "Unauthorized")
+            error = self.faults.apply()
+            if error is not None:
+                return error
+            if not case_number.startswith("6"):
+                return jsonify({"caseDetail": {"ErrorResponse": {"APIError": {
+                    "ErrorDescription": "Case not found"}}}})
+            return jsonify(case_detail(case_number))
+
+
+# cloudsso client_credentials token endpoint
+class FakeSSO(FakeServer):
+    def __init__(self, faults, expires_in=3600):
+        super(FakeSSO, self).__init__(Flask("fake-sso"))
+        self.faults = faults
+        self.tokens = 0
+
+        @self.app.route("/as/token.oauth2", methods=["POST"])
+        def token():
+            error = self.faults.apply()
+            if error is not None:
+                return error
+            self.tokens += 1
+            return jsonify({"access_token": "fake-token-{}".format(self.tokens), "token_type": "Bearer",
+                            "expires_in": expires_in})
+
+
+# A plausible case/v3 response for a case number
+def case_detail(case_number):
+    seed = int(case_number[-3:])
+    return {"caseDetail": {
+        "case_number": case_number,
+        "title": "Load test case {}".format(case_number),
+        "status": ["Customer Pending", "Cisco Pending", "Customer Updated", "Closed"][seed % 4],
+        "severity": str(seed % 4 + 1),
+        "serial_number": "FOC{:08d}".format(seed),
+        "contract_id": "9{:07d}".format(seed),
+        "creation_date": "2017-03-{:02d}T10:15:00.000Z".format(seed % 28 + 1),
+        "updated_date": "2017-04-{:02d}T16:45:00.000Z".format(seed % 28 + 1),
+        "owner_name": "TAC Engineer {}".format(seed % 10),
+        "owner_email": "engineer{}@cisco.com".format(seed % 10),
+        "contact_name": "Customer {}".format(seed),
+        "contact_user_id": "customer{}".format(seed),
+        "contact_email_ids": ["customer{}@example.com".format(seed)],
+        "contact_business_phone_numbers": ["+1 555 010 {:04d}".format(seed)],
+        "contact_mobile_phone_numbers": ["+1 555 020 {:04d}".format(seed)],
+        "rmas": ["8{:08d}".format(seed)] if seed % 3 == 0 else [],
+        "bugs": ["CSCvd{:05d}".format(seed)] if seed % 2 == 0 else []
+    }}
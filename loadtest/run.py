@@ -0,0 +1,235 @@
+#! /usr/bin/python
+"""
+    Load test for TAC Bot.
+
+    Starts local stand-ins for the Spark REST API, the Case API and cloudsso, points the bot at them,
+    then posts webhook payloads to the bot's process_webhook and times each command from the webhook
+    to the reply posted back to Spark.  No network access or real credentials are needed.
+
+    python loadtest/run.py --messages 1000 --concurrency 20 --case-latency 0.2 --case-error-rate 0.01
+
+    Bot settings such as WEBHOOK_WORKERS or CASE_CACHE_TTL are read from the environment as usual.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from fakes import Faults, FakeSpark, FakeCaseAPI, FakeSSO
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bot")
+
+# Commands sent when --commands is not given
+DEFAULT_COMMANDS = ["/title", "/device", "/owner", "/contract", "/customer", "/status", "/rma", "/bug",
+                    "/created", "/updated", "/link", "/help"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test TAC Bot against local fake Spark and Case API servers")
+    parser.add_argument("--messages", type=int, default=500, help="number of messages to send")
+    parser.add_argument("--concurrency", type=int, default=10, help="messages in flight at once")
+    parser.add_argument("--rooms", type=int, default=50, help="number of case rooms")
+    parser.add_argument("--cases", type=int, default=100, help="number of distinct case numbers")
+    parser.add_argument("--explicit-case-rate", type=float, default=0.3,
+                        help="fraction of messages naming a case number instead of using the room's")
+    parser.add_argument("--commands", default=",".join(DEFAULT_COMMANDS), help="comma separated commands to send")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each reply")
+    parser.add_argument("--seed", type=int, default=None)
+    for name, latency in (("spark", 0.05), ("case", 0.2), ("sso", 0.3)):
+        parser.add_argument("--{}-latency".format(name), type=float, default=latency,
+                            help="seconds added to each {} request".format(name))
+        parser.add_argument("--{}-jitter".format(name), type=float, default=latency / 2,
+                            help="random extra seconds added to each {} request".format(name))
+        parser.add_argument("--{}-error-rate".format(name), type=float, default=0.0,
+                            help="fraction of {} requests failing with a 500".format(name))
+    parser.add_argument("--spark-throttle-rate", type=float, default=0.0,
+                        help="fraction of messages posted to spark answered with a 429")
+    parser.add_argument("--spark-retry-after", type=int, default=1, help="Retry-After seconds of the spark 429s")
+    return parser.parse_args()
+
+
+def faults(args, name):
+    return Faults(getattr(args, name + "_latency"), getattr(args, name + "_jitter"), getattr(args, name + "_error_rate"),
+                  getattr(args, name + "_throttle_rate", 0.0), getattr(args, name + "_retry_after", 1))
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1)]
+
+
+# A Spark webhook payload for a new message, as Spark would post it
+def webhook_payload(webhook, message):
+    return {
+        "id": webhook["id"],
+        "name": webhook["name"],
+        "targetUrl": webhook["targetUrl"],
+        "resource": "messages",
+        "event": "created",
+        "actorId": message["personId"],
+        "data": {
+            "id": message["id"],
+            "roomId": message["roomId"],
+            "roomType": "group",
+            "personId": message["personId"],
+            "personEmail": message["personEmail"],
+            "created": message["created"]
+        }
+    }
+
+
+# Sends messages to the bot, at most one in flight per room so each reply can be matched to its message
+class LoadGenerator(object):
+    def __init__(self, app, spark, webhook, rooms, users, case_numbers, commands, args):
+        self.app = app
+        self.spark = spark
+        self.webhook = webhook
+        self.users = users
+        self.case_numbers = case_numbers
+        self.commands = commands
+        self.args = args
+        self.free_rooms = list(rooms)
+        self.rooms_available = threading.Condition()
+        self.results = []       # (command, seconds, outcome)
+        self.results_lock = threading.Lock()
+        self.remaining = args.messages
+        self.remaining_lock = threading.Lock()
+
+    def take_room(self):
+        with self.rooms_available:
+            while not self.free_rooms:
+                self.rooms_available.wait()
+            return self.free_rooms.pop(random.randrange(len(self.free_rooms)))
+
+    def release_room(self, room):
+        with self.rooms_available:
+            self.free_rooms.append(room)
+            self.rooms_available.notify()
+
+    def next_message(self):
+        with self.remaining_lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def send_one(self, client):
+        room = self.take_room()
+        command = random.choice(self.commands)
+        text = command
+        if command != "/help" and random.random() < self.args.explicit_case_rate:
+            text = "{} {}".format(command, random.choice(self.case_numbers))
+
+        replied = threading.Event()
+        self.spark.reply_listeners[room["id"]] = lambda reply: replied.set()
+        message = self.spark.add_message(room["id"], random.choice(self.users), text)
+        try:
+            started = time.time()
+            response = client.post("/", data=json.dumps(webhook_payload(self.webhook, message)),
+                                   content_type="application/json")
+            if response.status_code != 200:
+                outcome = "rejected"
+            elif replied.wait(self.args.timeout):
+                outcome = "ok"
+            else:
+                outcome = "timeout"
+            self.record(command, time.time() - started, outcome)
+        finally:
+            del self.spark.reply_listeners[room["id"]]
+            self.release_room(room)
+
+    def record(self, command, seconds, outcome):
+        with self.results_lock:
+            self.results.append((command, seconds, outcome))
+
+    def worker(self):
+        client = self.app.test_client()
+        while self.next_message():
+            self.send_one(client)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, name="load-{}".format(i))
+                   for i in range(self.args.concurrency)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - started
+
+
+# Print throughput and latency percentiles for each command
+def report(results, elapsed, servers):
+    print()
+    print("{} messages in {:.1f}s: {:.1f} messages/s".format(len(results), elapsed, len(results) / elapsed))
+    print()
+    print("{:<12} {:>7} {:>7} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        "command", "count", "errors", "msg/s", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for command in sorted(set(r[0] for r in results)) + ["all"]:
+        rows = [r for r in results if command in ("all", r[0])]
+        latencies = sorted(seconds * 1000 for c, seconds, outcome in rows if outcome == "ok")
+        errors = sum(1 for r in rows if r[2] != "ok")
+        print("{:<12} {:>7} {:>7} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            command, len(rows), errors, len(rows) / elapsed, percentile(latencies, 50), percentile(latencies, 95),
+            percentile(latencies, 99), latencies[-1] if latencies else 0.0))
+    print()
+    print("Upstream requests: " + ", ".join("{} {}".format(name, server.requests) for name, server in servers))
+
+
+# Wait for the bot's background startup steps to pass, as a load balancer would
+def wait_until_ready(app, timeout=30):
+    client = app.test_client()
+    deadline = time.time() + timeout
+    while client.get("/ready").status_code != 200:
+        if time.time() > deadline:
+            sys.exit("Bot not ready after {}s: {}".format(timeout, client.get("/ready").data))
+        time.sleep(0.05)
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+
+    spark = FakeSpark(faults(args, "spark")).start()
+    case_api = FakeCaseAPI(faults(args, "case")).start()
+    sso = FakeSSO(faults(args, "sso")).start()
+
+    # The bot reads its endpoints and credentials when it is imported
+    os.environ.update({
+        "SPARK_API_URL": spark.url + "/v1/",
+        "CASE_API_URL": case_api.url,
+        "SSO_URL": sso.url,
+        "SPARK_BOT_TOKEN": "load-test-token",
+        "SPARK_BOT_EMAIL": spark.bot["emails"][0],
+        "SPARK_BOT_URL": "http://127.0.0.1/",
+        "SPARK_BOT_APP_NAME": "tacbot-loadtest",
+        "CASE_API_CLIENT_ID": "load-test-client",
+        "CASE_API_CLIENT_SECRET": "load-test-secret"
+    })
+    sys.path.insert(0, os.path.abspath(BOT_DIR))
+    import bot
+    app = bot.create_app()
+    bot.start_background_setup()
+    wait_until_ready(app)
+    webhook = [w for w in spark.webhooks.values() if w["resource"] == "messages"][0]
+
+    users = [spark.add_person("engineer{}@cisco.com".format(i)) for i in range(20)]
+    case_numbers = [str(612000000 + i) for i in range(args.cases)]
+    rooms = [spark.add_room("SR {}: load test".format(case_numbers[i % len(case_numbers)]), users)
+             for i in range(max(args.rooms, args.concurrency))]
+
+    generator = LoadGenerator(app, spark, webhook, rooms, users, case_numbers, args.commands.split(","), args)
+    elapsed = generator.run()
+    report(generator.results, elapsed, [("spark", spark), ("case_api", case_api), ("sso", sso)])
+
+
+if __name__ == '__main__':
+    main()
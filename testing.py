@@ -1,6 +1,29 @@
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from email.utils import formatdate
+import requests
+from ciscosparkapi import SparkApiError
 import bot.bot
+import bot.cache
+import bot.case
+import bot.case_store
+import bot.context
+import bot.dedupe
+import bot.message_parser
+import bot.metrics
+import bot.room_index
+import bot.singleflight
+import bot.startup
+import bot.tracing
+import bot.monitor
+import bot.outbound
+import bot.ratelimit
 import bot.utilities
+import bot.workers
 
 class testcases(unittest.TestCase):
     def setUp(self):
@@ -30,4 +53,485 @@ class testcases(unittest.TestCase):
         test = bot.utilities.check_cisco_user("somename@yahoo.com")
         self.assertFalse(test)
 
+    def test_007_access_token_is_cached(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {"access_token": u"token{}".format(len(calls)), "expires_in": 3599}
+
+        manager = bot.utilities.AccessTokenManager(fetch)
+        self.assertEqual(manager.get_token(), u"token1")
+        self.assertEqual(manager.get_token(), u"token1")
+        manager.invalidate(u"token1")
+        self.assertEqual(manager.get_token(), u"token2")
+        self.assertEqual(len(calls), 2)
+
+    def test_008_case_cache_lru_eviction(self):
+        cache = bot.cache.TTLCache(ttl=300, max_entries=2)
+        cache.set("612345678", {"caseDetail": {}})
+        cache.set("698765432", {"caseDetail": {}})
+        cache.get("612345678")
+        cache.set("611111111", {"caseDetail": {}})
+        self.assertIn("612345678", cache)
+        self.assertNotIn("698765432", cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertTrue(cache.invalidate("612345678"))
+        self.assertIsNone(cache.get("612345678"))
+
+    def test_009_worker_pool_drains_on_shutdown(self):
+        handled = []
+        pool = bot.workers.WorkerPool(handled.append, num_workers=2, max_depth=10)
+        for i in range(5):
+            self.assertTrue(pool.submit(i))
+        pool.shutdown()
+        self.assertEqual(sorted(handled), [0, 1, 2, 3, 4])
+        self.assertFalse(pool.submit(5))
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+    def test_010_dedupe_drops_redelivered_message(self):
+        for store in [bot.dedupe.MemoryDedupeStore(window=600, max_entries=100),
+                      bot.dedupe.SqliteDedupeStore(":memory:", window=600)]:
+            self.assertFalse(store.seen("message1"))
+            self.assertTrue(store.seen("message1"))
+            store.forget("message1")
+            self.assertFalse(store.seen("message1"))
+
+    def test_011_room_index_finds_room_for_member(self):
+        index = bot.room_index.RoomIndex()
+        index.rebuild([("room1", "612345678"), ("room2", False)], lambda room_id: ["person1"])
+        self.assertEqual(index.find_room("612345678", "person1"), "room1")
+        self.assertIsNone(index.find_room("612345678", "person2"))
+        index.add_member("room1", "person2")
+        self.assertEqual(index.find_room("612345678", "person2"), "room1")
+        index.remove_room("room1")
+        self.assertIsNone(index.find_room("612345678", "person1"))
+
+    def test_012_find_command_uses_first_command(self):
+        self.assertEqual(bot.bot.find_command("/feedback the /bug command is broken"), "/feedback")
+        self.assertEqual(bot.bot.find_command("TAC /status 612345678"), "/status")
+        self.assertEqual(bot.bot.find_command("hello"), "")
+        self.assertIs(bot.bot.command_functions["/help"], bot.bot.send_help)
+
+    def test_013_request_context_argument(self):
+        class Message(object):
+            personEmail = "somename@cisco.com"
+            text = "TAC /invite  somename@cisco.com "
+
+        post_data = {"data": {"id": "message1", "roomId": "room1", "personId": "person1"}}
+        parsed = bot.message_parser.parse_message(Message.text, ["/invite"])
+        ctx = bot.context.RequestContext(post_data, Message(), parsed)
+        self.assertEqual(ctx.argument, "somename@cisco.com")
+        self.assertEqual(ctx.emails, ["somename@cisco.com"])
+        self.assertEqual(ctx.room_id, "room1")
+
+    def test_014_verify_case_numbers(self):
+        test = bot.utilities.verify_case_numbers("/status 612345678 698765432, 612345678")
+        self.assertEqual(test, ["612345678", "698765432"])
+
+    def test_015_monitor_reports_changed_fields(self):
+        old = {"status": "Customer Pending", "severity": "2", "rmas": ("800000001",)}
+        new = {"status": "Customer Pending", "severity": "1", "rmas": ("800000001", "800000002")}
+        message = bot.monitor.format_changes("612345678", bot.monitor.diff_snapshots(old, new))
+        self.assertIn("Severity: 2 -> **1**", message)
+        self.assertIn("RMAs added: 800000002", message)
+        self.assertNotIn("Status", message)
+
+    def test_016_metrics_histogram_render(self):
+        registry = bot.metrics.Registry()
+        histogram = registry.histogram("latency_seconds", "Latency", ["command"], buckets=(0.1, 1.0))
+        histogram.observe(0.05, "/status")
+        histogram.observe(0.5, "/status")
+        histogram.observe(5, "/status")
+        text = registry.render()
+        self.assertIn('latency_seconds_bucket{command="/status",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{command="/status",le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{command="/status",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{command="/status"} 3', text)
+
+    def test_017_slow_trace_recorded(self):
+        bot.tracing.start_trace("message", command="/status")
+        with bot.tracing.span("get_case_details"):
+            pass
+        trace = bot.tracing.finish_trace(threshold=0)
+        self.assertEqual(bot.tracing.recent_slow_traces(1)[0]["id"], trace.id)
+        self.assertEqual([s["name"] for s in trace.to_dict()["spans"]], ["get_case_details"])
+        self.assertIsNone(bot.tracing.current_trace())
+
+    def test_018_room_index_counts(self):
+        index = bot.room_index.RoomIndex()
+        index.rebuild([("room1", "612345678"), ("room2", "698765432"), ("room3", False)], lambda room_id: [])
+        index.set_case_closed("612345678", True)
+        index.add_room("room4", False)
+        counts = index.counts()
+        self.assertEqual(counts["total"], 4)
+        self.assertEqual(counts["other_rooms"], 2)
+        self.assertEqual(counts["closed_case_rooms"], 1)
+        self.assertEqual(counts["unknown_case_rooms"], 1)
+        index.remove_room("room1")
+        self.assertEqual(index.counts()["closed_case_rooms"], 0)
+
+    def test_019_case_detail_parsed_once(self):
+        case_json = {"caseDetail": {"title": "Test", "rmas": ["800000001"], "status": "Customer Pending",
+                                    "creation_date": "2017-03-01T10:15:00.000Z"}}
+        case = bot.case.CaseDetail(case_json)
+        self.assertEqual(case.rmas, ("800000001",))
+        self.assertEqual(case.created_at.day, 1)
+        self.assertIsNone(case.error)
+        self.assertIsNone(case.json)
+        self.assertIs(bot.case.CaseDetail(case_json, keep_json=True).json, case_json)
+
+    def test_020_parser_case_number_word_boundaries(self):
+        parsed = bot.message_parser.parse_message("612345678 /status 6123456789 7698765432 698765432", ["/status"])
+        self.assertEqual(parsed.command, "/status")
+        self.assertEqual(parsed.case_numbers, ["698765432"])
+        self.assertFalse(bot.utilities.verify_case_number("serial 16123456789"))
+
+    def test_021_startup_ready_once_checks_pass(self):
+        state = bot.startup.StartupState()
+        state.add_check("spark")
+        state.add_check("webhooks")
+        with state.phase("spark", check="spark"):
+            pass
+        with self.assertRaises(IOError):
+            with state.phase("webhooks", check="webhooks"):
+                raise IOError("Spark unavailable")
+        self.assertEqual(state.pending(), ["webhooks"])
+        self.assertEqual(state.to_dict()["errors"], {"webhooks": "Spark unavailable"})
+        with state.phase("webhooks", check="webhooks"):
+            pass
+        self.assertTrue(state.ready())
+        self.assertEqual(list(state.to_dict()["startup_seconds"]), ["spark", "webhooks"])
+
+    def test_022_outbound_retries_429_in_order(self):
+        throttled = requests.Response()
+        throttled.headers["Retry-After"] = "0"
+        sent = []
+
+        def send(message):
+            if message["markdown"] == "first" and not sent:
+                sent.append("429")
+                raise SparkApiError(429, response=throttled)
+            sent.append(message["markdown"])
+
+        outbound = bot.outbound.OutboundQueue(send, bot.ratelimit.TokenBucket(1000), num_workers=2, max_depth=10)
+        for markdown in ("first", "second", "third"):
+            self.assertTrue(outbound.submit("room1", {"roomId": "room1", "markdown": markdown}))
+        outbound.shutdown(timeout=5)
+        self.assertEqual(sent, ["429", "first", "second", "third"])
+        self.assertEqual(outbound.stats()["retried"], 1)
+        self.assertFalse(outbound.submit("room1", {"roomId": "room1", "markdown": "late"}))
+
+    def test_023_case_store_survives_restart(self):
+        path = os.path.join(tempfile.mkdtemp(), "cases.db")
+        store = bot.case_store.SqliteCaseStore(path, {"cases": 300, "rooms": 300}, max_bytes=10 ** 6)
+        case = bot.case.CaseDetail({"caseDetail": {"title": "Test", "rmas": ["800000001"]}})
+        store.put("cases", "612345678", case.to_json(), stored_at=time.time() - 60)
+        store.put("cases", "698765432", case.to_json(), stored_at=time.time() - 600)
+        store.close()
+
+        restarted = bot.case_store.SqliteCaseStore(path, {"cases": 300, "rooms": 300}, max_bytes=10 ** 6)
+        data, stored_at = restarted.get("cases", "612345678")
+        self.assertEqual(bot.case.CaseDetail(data).rmas, ("800000001",))
+        self.assertLess(stored_at, time.time() - 59)
+        self.assertIsNone(restarted.get("cases", "698765432"))
+        self.assertEqual(restarted.compact(), 1)
+        restarted.max_bytes = 0
+        self.assertEqual(restarted.compact(), 1)
+        self.assertEqual(restarted.size(), 0)
+
+    def test_024_stale_case_served_with_age(self):
+        stale = bot.case.CaseDetail({"caseDetail": {"title": "Test"}},
+                                    fetched_at=time.time() - bot.utilities.CASE_CACHE_TTL - 60)
+        self.assertTrue(bot.utilities.case_is_stale(stale))
+        self.assertIn("As of 0:0", bot.bot.case_age_note(stale))
+        self.assertEqual(bot.bot.case_age_note(bot.case.CaseDetail({"caseDetail": {"title": "Test"}})), "")
+
+    def test_025_single_flight_shares_result_and_error(self):
+        flight = bot.singleflight.SingleFlight("test")
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch(case_number):
+            calls.append(case_number)
+            release.wait(5)
+            return "details for " + case_number
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do("612345678", fetch, "612345678")))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        while flight.shared < 4:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, ["612345678"])
+        self.assertEqual(results, ["details for 612345678"] * 5)
+        self.assertEqual(flight.in_flight(), 0)
+
+        def fail():
+            raise IOError("Case API unavailable")
+        self.assertRaises(IOError, flight.do, "612345678", fail)
+
+    def test_026_sqlite_room_index_keeps_concurrent_changes(self):
+        path = os.path.join(tempfile.mkdtemp(), "rooms.db")
+        bot.room_index.create_room_index(path).rebuild([("room1", "612345678"), ("room2", False)], lambda room_id: [])
+        indexes = [bot.room_index.create_room_index(path) for i in range(2)]
+
+        def add_members(index, prefix):
+            for i in range(100):
+                index.add_member("room1", "{}{}".format(prefix, i))
+        threads = [threading.Thread(target=add_members, args=(index, "person{}-".format(n)))
+                   for n, index in enumerate(indexes)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        index = bot.room_index.create_room_index(path)
+        self.assertTrue(index.built)
+        self.assertEqual(index.find_room("612345678", "person1-99"), "room1")
+        self.assertEqual(len(index._query("SELECT * FROM members")), 200)
+        index.set_case_closed("612345678", True)
+        self.assertEqual(indexes[0].counts()["closed_case_rooms"], 1)
+        self.assertEqual(indexes[0].counts()["other_rooms"], 1)
+
+    def test_027_membership_change_skipped_until_index_built(self):
+        self.assertFalse(bot.utilities.room_index.built)
+        # Would look the room up in Spark if the index were built
+        bot.utilities.update_room_index("created", "room1", "person1")
+        self.assertFalse(bot.utilities.room_index.has_room("room1"))
+
+    def test_028_failed_refresh_keeps_cached_case(self):
+        case = bot.case.CaseDetail({"caseDetail": {"title": "Test"}})
+        bot.utilities.case_cache.set("612345678", case)
+        fetch_case_details = bot.utilities.fetch_case_details
+
+        def unavailable(case_number):
+            raise IOError("Case API unavailable")
+        bot.utilities.fetch_case_details = unavailable
+        try:
+            self.assertRaises(IOError, bot.utilities.refresh_case_details, "612345678")
+        finally:
+            bot.utilities.fetch_case_details = fetch_case_details
+        self.assertIs(bot.utilities.case_cache.get("612345678"), case)
+        bot.utilities.invalidate_case("612345678")
+
+    def test_029_worker_pool_drain_timeout_is_shared(self):
+        release = threading.Event()
+        pool = bot.workers.WorkerPool(lambda item: release.wait(5), num_workers=4, max_depth=10)
+        for i in range(4):
+            pool.submit(i)
+        started = time.time()
+        pool.shutdown(timeout=0.2)
+        self.assertLess(time.time() - started, 0.6)
+        release.set()
+
+    def test_030_message_without_room_is_not_queued(self):
+        self.assertFalse(bot.bot.send_message(roomId=None, markdown="feedback"))
+        self.assertEqual(bot.bot.outbound.depth(), 0)
+
+        sent = []
+        outbound = bot.outbound.OutboundQueue(sent.append, bot.ratelimit.TokenBucket(1000), num_workers=1,
+                                              max_depth=10)
+        self.assertTrue(outbound.submit(None, {"markdown": "first"}))
+        self.assertTrue(outbound.submit("room1", {"markdown": "second"}))
+        outbound.shutdown(timeout=5)
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(outbound.depth(), 0)
+
+    def test_031_worker_pool_shutdown_with_full_queue(self):
+        release = threading.Event()
+        pool = bot.workers.WorkerPool(lambda item: release.wait(5), num_workers=2, max_depth=3)
+        accepted = 0
+        while pool.submit(accepted):
+            accepted += 1
+        self.assertEqual(pool.depth(), pool.max_depth)
+        started = time.time()
+        pool.shutdown(timeout=0.2)
+        self.assertLess(time.time() - started, 0.6)
+        self.assertFalse(pool.submit("late"))
+        release.set()
+
+    def test_032_case_store_invalidation_reaches_other_processes(self):
+        path = os.path.join(tempfile.mkdtemp(), "cases.db")
+        worker1 = bot.case_store.SqliteCaseStore(path, {"cases": 300, "rooms": 300}, max_bytes=10 ** 6)
+        worker2 = bot.case_store.SqliteCaseStore(path, {"cases": 300, "rooms": 300}, max_bytes=10 ** 6)
+        dropped1, dropped2 = [], []
+        worker1.on_invalidate(lambda table, key: dropped1.append(key))
+        worker2.on_invalidate(lambda table, key: dropped2.append(key))
+        worker1.put("rooms", "room1", "SR 612345678: Old title")
+        worker1.flush()
+        self.assertEqual(worker2.get("rooms", "room1")[0], "SR 612345678: Old title")
+
+        worker1.invalidate("rooms", "room1")
+        worker1.put("rooms", "room1", "SR 612345678: New title")
+        worker1.flush()
+        worker1.sync()
+        worker2.sync()
+        self.assertEqual(dropped1, [])
+        self.assertEqual(dropped2, ["room1"])
+        self.assertEqual(worker2.get("rooms", "room1")[0], "SR 612345678: New title")
+        worker2.sync()
+        self.assertEqual(dropped2, ["room1"])
+
+    def test_033_rooms_answers_while_index_is_built(self):
+        recounts = []
+        start_room_recount = bot.utilities.start_room_recount
+        bot.utilities.start_room_recount = lambda: recounts.append(True)
+        try:
+            self.assertFalse(bot.utilities.room_index.built)
+            response = bot.bot.app.test_client().get("/rooms")
+        finally:
+            bot.utilities.start_room_recount = start_room_recount
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(recounts, [True])
+
+    def test_034_case_replies_fan_out(self):
+        class Context(object):
+            person_id = "person1"
+            case_numbers = ["612345678", "698765432", "611111111"]
+
+        found = bot.case.CaseDetail({"caseDetail": {"title": "Test"}})
+        not_found = bot.case.CaseDetail({"caseDetail": {"ErrorResponse": {"APIError": {
+            "ErrorDescription": "Case not found"}}}})
+        looked_up = []
+
+        def get_many_case_details(case_numbers):
+            looked_up.extend(case_numbers)
+            return [found, not_found][:len(case_numbers)]
+        patched = {"check_cisco_person": lambda person_id: True, "get_many_case_details": get_many_case_details,
+                   "CASE_MAX_PER_COMMAND": 2}
+        saved = dict((name, getattr(bot.bot, name)) for name in patched)
+        for name, value in patched.items():
+            setattr(bot.bot, name, value)
+        try:
+            reply = bot.bot.send_case_replies(Context(), lambda case_number, case: "SR {} found".format(case_number))
+        finally:
+            for name, value in saved.items():
+                setattr(bot.bot, name, value)
+        self.assertEqual(looked_up, ["612345678", "698765432"])
+        self.assertEqual(reply.split("\n\n"), ["SR 612345678 found", "SR 698765432: Case not found",
+                                               "Only the first 2 case numbers were looked up"])
+
+    def test_035_http_request_retries(self):
+        class Response(object):
+            def __init__(self, status_code, retry_after=None):
+                self.status_code = status_code
+                self.headers = {"Retry-After": retry_after} if retry_after else {}
+
+            def close(self):
+                pass
+
+        class Session(object):
+            def __init__(self, responses):
+                self.responses = list(responses)
+                self.calls = []
+
+            def request(self, method, url, **kwargs):
+                self.calls.append(kwargs)
+                return self.responses.pop(0)
+
+        class Clock(object):
+            def __init__(self):
+                self.sleeps = []
+
+            def time(self):
+                return time.time()
+
+            def sleep(self, seconds):
+                self.sleeps.append(seconds)
+
+        self.assertEqual(bot.utilities.get_retry_after(Response(429, "7")), 7.0)
+        self.assertAlmostEqual(bot.utilities.get_retry_after(Response(429, formatdate(time.time() + 20, usegmt=True))),
+                               20, delta=2)
+        self.assertIsNone(bot.utilities.get_retry_after(Response(429)))
+
+        http_session, utilities_time = bot.utilities.http_session, bot.utilities.time
+        try:
+            bot.utilities.time = clock = Clock()
+            bot.utilities.http_session = session = Session([Response(429, "2"), Response(503), Response(502),
+                                                            Response(200)])
+            self.assertEqual(bot.utilities.http_request("GET", "https://api.example.com/x").status_code, 200)
+            backoff = bot.utilities.HTTP_BACKOFF_FACTOR
+            self.assertEqual(clock.sleeps, [2.0, backoff * 2, backoff * 4])
+            self.assertEqual(session.calls[0]["timeout"],
+                             (bot.utilities.HTTP_CONNECT_TIMEOUT, bot.utilities.HTTP_READ_TIMEOUT))
+
+            # Gives up after HTTP_MAX_RETRIES retries, returning the last response
+            bot.utilities.time = clock = Clock()
+            bot.utilities.http_session = session = Session([Response(500)] * (bot.utilities.HTTP_MAX_RETRIES + 2))
+            self.assertEqual(bot.utilities.http_request("GET", "https://api.example.com/x", timeout=1).status_code, 500)
+            self.assertEqual(len(session.calls), bot.utilities.HTTP_MAX_RETRIES + 1)
+            self.assertEqual(len(clock.sleeps), bot.utilities.HTTP_MAX_RETRIES)
+            self.assertEqual(session.calls[0]["timeout"], 1)
+        finally:
+            bot.utilities.http_session, bot.utilities.time = http_session, utilities_time
+
+    def test_036_person_directory_is_cached(self):
+        class Person(object):
+            def __init__(self, person_id, email):
+                self.id = person_id
+                self.emails = [email]
+
+        class People(object):
+            def __init__(self):
+                self.calls = []
+
+            def get(self, person_id):
+                self.calls.append(person_id)
+                return Person(person_id, {"person7": "someone@cisco.com", "person8": "someone@example.com"}[person_id])
+
+            def list(self, email):
+                self.calls.append(email)
+                return [Person("person9", email)]
+
+        class Spark(object):
+            people = People()
+
+        get_spark = bot.utilities.get_spark
+        bot.utilities.get_spark = lambda: Spark
+        try:
+            for i in range(2):
+                self.assertTrue(bot.utilities.check_cisco_person("person7"))
+                self.assertFalse(bot.utilities.check_cisco_person("person8"))
+                self.assertEqual(bot.utilities.get_person_id("Other@cisco.com"), "person9")
+                self.assertEqual(bot.utilities.get_email("person9"), "Other@cisco.com")
+                self.assertEqual(bot.utilities.get_person_id("other@cisco.com"), "person9")
+        finally:
+            bot.utilities.get_spark = get_spark
+            for person_id in ("person7", "person8", "person9"):
+                bot.utilities.person_emails.invalidate(person_id)
+                bot.utilities.person_authorized.invalidate(person_id)
+            bot.utilities.person_ids.invalidate("other@cisco.com")
+        self.assertEqual(Spark.people.calls, ["person7", "person8", "Other@cisco.com"])
+
+    def test_037_webhooks_from_the_bot_are_ignored(self):
+        class Workers(object):
+            def __init__(self):
+                self.submitted = []
+
+            def submit(self, post_data):
+                self.submitted.append(post_data["data"]["id"])
+                return True
+
+        def message(message_id, **person):
+            return {"resource": "messages", "event": "created", "data": dict(id=message_id, roomId="room1", **person)}
+
+        bot_identity, webhook_workers = bot.bot.bot_identity, bot.bot.webhook_workers
+        bot.bot.bot_identity = set(["tacbot@sparkbot.io", "botperson1"])
+        bot.bot.webhook_workers = workers = Workers()
+        try:
+            client = bot.bot.app.test_client()
+            for post_data in (message("test037-1", personEmail="tacbot@sparkbot.io", personId="botperson1"),
+                              message("test037-2", personId="botperson1"),
+                              message("test037-3", personEmail="somename@cisco.com", personId="person1")):
+                response = client.post("/", data=json.dumps(post_data), content_type="application/json")
+                self.assertEqual(response.status_code, 200)
+        finally:
+            bot.bot.bot_identity, bot.bot.webhook_workers = bot_identity, webhook_workers
+        self.assertEqual(workers.submitted, ["test037-3"])
+
 unittest.main()
\ No newline at end of file